@@ -0,0 +1,102 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from controller import shared_transport
+
+# create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to info
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(lineno)s:%(funcName)s - %(message)s'))
+logger.addHandler(ch)
+
+
+class ArtworkCache:
+    """
+    Card artwork kept on disk between qrgen runs.
+
+    Images are stored once per content (named by their SHA-256) and found by
+    a stable key given by the caller, e.g. an album and its artist instead of
+    a cover.cgi URL carrying the current session id.  An image older than
+    `max_age` seconds is revalidated with If-None-Match/If-Modified-Since,
+    so an unchanged one is not downloaded again.
+    """
+
+    def __init__(self, directory='.artwork-cache', max_age=86400, transport=None):
+        self.directory = directory
+        self.max_age = max_age
+        self.transport = transport or shared_transport()
+        self.index_file = os.path.join(directory, 'index.json')
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_file) as index_file:
+                self._index = json.load(index_file)
+        except (OSError, ValueError):
+            self._index = {}
+
+    def fetch(self, url, target, key=None):
+        """Copies the image at url (cached as key, default url) to target, False if there is none."""
+        key = key or url
+        with self._lock:
+            entry = self._index.get(key)
+        if entry and not os.path.exists(self._blob(entry['sha256'])):
+            entry = None
+
+        if entry and time.time() - entry['checked'] < self.max_age:
+            logger.debug('%s cached', key)
+        else:
+            try:
+                entry = self._download(url, key, entry)
+            except Exception as e:
+                if not entry:
+                    logger.error('could not download %s: %s', url, e)
+                    return False
+                logger.warning('could not revalidate %s, using the cached image: %s', key, e)
+        shutil.copyfile(self._blob(entry['sha256']), target)
+        return True
+
+    def _download(self, url, key, entry):
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.transport.get(url, backend='artwork', api='artwork', headers=headers)
+        if response.status_code == 304 and entry:
+            logger.debug('%s not modified', key)
+            entry = dict(entry, checked=time.time())
+        else:
+            response.raise_for_status()
+            sha256 = hashlib.sha256(response.content).hexdigest()
+            if not os.path.exists(self._blob(sha256)):
+                with open(self._blob(sha256) + '.tmp', 'wb') as blob:
+                    blob.write(response.content)
+                os.replace(self._blob(sha256) + '.tmp', self._blob(sha256))
+            logger.info('downloaded %s (%d bytes)', key, len(response.content))
+            entry = {'sha256': sha256, 'checked': time.time(),
+                     'etag': response.headers.get('ETag'),
+                     'last_modified': response.headers.get('Last-Modified')}
+
+        with self._lock:
+            self._index[key] = entry
+            self._save()
+        return entry
+
+    def _blob(self, sha256):
+        return os.path.join(self.directory, sha256)
+
+    def _save(self):
+        with open(self.index_file + '.tmp', 'w') as index_file:
+            json.dump(self._index, index_file)
+        os.replace(self.index_file + '.tmp', self.index_file)
@@ -1,10 +1,27 @@
+import functools
+import logging
 import requests
+import threading
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
 
-import urllib
-from urllib.request import urlopen
 from urllib.parse import quote
 
+from metrics import metrics
+
+# create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to info
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(lineno)s:%(funcName)s - %(message)s'))
+logger.addHandler(ch)
+
 
 def strip_title_junk(title):
     junk = [' (Original', ' - From', ' (Remaster', ' [Remaster']
@@ -20,20 +37,178 @@ class TypeMode:
     VIDEO = 'video'
 
 
+class RequestTrace:
+    """The HTTP requests made for one action: (api, status, bytes, seconds) each."""
+
+    def __init__(self, name):
+        self.name = name
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def add(self, api, status, size, seconds):
+        with self._lock:
+            self.requests.append((api, status, size, seconds))
+
+    @property
+    def count(self):
+        return len(self.requests)
+
+    @property
+    def bytes(self):
+        return sum(r[2] for r in self.requests)
+
+    @property
+    def seconds(self):
+        return sum(r[3] for r in self.requests)
+
+    def check(self, max_requests, max_bytes=None):
+        """Raises an AssertionError when the action needed more than its budget."""
+        if self.count > max_requests or (max_bytes is not None and self.bytes > max_bytes):
+            raise AssertionError('%s needed %s, allowed are %d requests%s' % (
+                self.name, self, max_requests, '' if max_bytes is None else ' / %d bytes' % max_bytes))
+
+    def __str__(self):
+        return '%d requests, %.1fkB, %.0fms [%s]' % (
+            self.count, self.bytes / 1024, self.seconds * 1000,
+            ', '.join('%s %s %dB %.0fms' % (api, status, size, seconds * 1000)
+                      for (api, status, size, seconds) in self.requests))
+
+
+class HttpTransport:
+    """
+    HTTP client shared by all controllers.
+
+    Connections are pooled and kept alive between calls, so a scanned card
+    does not pay for a new TCP (or TLS) handshake with the NAS.  Every call
+    has a connect and a read timeout, asks for gzip compressed responses and
+    is timed in the qrocodile_http_seconds metric.
+
+    Requests made within trace() are recorded, with their size and time, in
+    the RequestTrace it returns; bind() carries the traces of the calling
+    thread over to a function run on another one.
+    """
+
+    def __init__(self, pool_size=4, connect_timeout=3.05, read_timeout=10.0):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                     'Connection': 'keep-alive'})
+        self._local = threading.local()
+
+    def _traces(self):
+        if not hasattr(self._local, 'traces'):
+            self._local.traces = []
+        return self._local.traces
+
+    @contextmanager
+    def trace(self, name):
+        """Records the requests of the current thread until the block is left, then logs them."""
+        trace = RequestTrace(name)
+        self._traces().append(trace)
+        try:
+            yield trace
+        finally:
+            self._traces().remove(trace)
+            logger.info('%s: %s', name, trace)
+
+    def bind(self, function):
+        """Wraps function so its requests also count for the traces active now."""
+        traces = list(self._traces())
+
+        def traced(*args, **kwargs):
+            self._local.traces = self._traces() + traces
+            try:
+                return function(*args, **kwargs)
+            finally:
+                for trace in traces:
+                    self._local.traces.remove(trace)
+        return traced
+
+    def get(self, url, params=None, backend='default', api=None, **kwargs):
+        started = time.perf_counter()
+        with metrics.timer('qrocodile_http_seconds', backend=backend, api=api or url):
+            response = self.session.get(url, params=params, timeout=self.timeout, **kwargs)
+        if self._traces():
+            size = response.headers.get('Content-Length')
+            if size is None:
+                # a streamed body is not read here
+                size = 0 if kwargs.get('stream') else len(response.content)
+            for trace in self._traces():
+                trace.add(api or url, response.status_code, int(size), time.perf_counter() - started)
+        return response
+
+    def get_json(self, url, params=None, backend='default', api=None):
+        response = self.get(url, params, backend, api)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def configure_transport(**settings):
+    """Replaces the shared transport, e.g. with timeouts read from qrocodile.ini."""
+    global _transport
+    with _transport_lock:
+        _transport = HttpTransport(**settings)
+    return _transport
+
+
+def traced(method):
+    """Records the HTTP requests of a controller action, see HttpTransport.trace()."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.transport.trace('%s.%s' % (type(self).__name__, method.__name__)):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def request_budget(max_requests, max_bytes=None, transport=None):
+    """
+    Fails with an AssertionError when the block makes more requests (or
+    transfers more bytes) than allowed, e.g.
+
+        with request_budget(2):
+            controller.play_video(None, payload)
+    """
+    with (transport or shared_transport()).trace('budget') as trace:
+        yield trace
+    trace.check(max_requests, max_bytes)
+
+
+def shared_transport():
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = HttpTransport()
+        return _transport
+
+
 class RequestController(ABC):
 
-    def __init__(self, base_url, namespace="default"):
+    def __init__(self, base_url, namespace="default", transport=None):
         self.base_url = base_url
         self.room = "default"
         self.current_mode = TypeMode.VIDEO
         self.namespace = namespace
+        self.transport = transport or shared_transport()
         super().__init__()
 
     def perform_request(self, path):
         url = "%s/%s" % (self.base_url, path)
-        response = urlopen(url)
-        result = response.read()
-        print(result)
+        response = self.transport.get(url, backend=self.namespace, api=path.split('/')[0])
+        response.raise_for_status()
+        if response.headers.get('Content-Type', '').startswith('application/json'):
+            return response.json()
+        return response.text
 
 
 class PlayController(RequestController):
@@ -83,5 +258,11 @@ class DummyController(PlayController):
         self.perform_request("%s/%s" % (self.room, path))
 
     def handle_command(self, qrcode):
-        print("DUMMY --- command: %s" & qrcode)
+        print("DUMMY --- command: %s" % qrcode)
         return None
+
+    def play_audio(self, containers_json):
+        print("DUMMY --- play audio: %s" % containers_json)
+
+    def play_video(self, path, payload=None):
+        print("DUMMY --- play video: %s" % payload)
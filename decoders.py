@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+
+import cv2
+
+# a decoded code, `data` are the raw bytes and `rect` is (x, y, width, height)
+Barcode = namedtuple('Barcode', ['data', 'type', 'rect'])
+
+
+class Decoder(ABC):
+    """Finds QR codes in an 8-bit grayscale image."""
+
+    name = None
+
+    @abstractmethod
+    def decode(self, image):
+        pass
+
+    def __call__(self, image):
+        return self.decode(image)
+
+
+class PyzbarDecoder(Decoder):
+    name = 'pyzbar'
+
+    def __init__(self):
+        from pyzbar import pyzbar
+        self._pyzbar = pyzbar
+        # the cards only carry QR codes, skip looking for other symbologies
+        self._symbols = [pyzbar.ZBarSymbol.QRCODE]
+
+    def decode(self, image):
+        return [Barcode(b.data, b.type, tuple(b.rect))
+                for b in self._pyzbar.decode(image, symbols=self._symbols)]
+
+
+class OpenCVDecoder(Decoder):
+    name = 'opencv'
+
+    def __init__(self):
+        self._detector = cv2.QRCodeDetector()
+
+    def decode(self, image):
+        # a card slot holds a single card, and the multi code detector misses small codes
+        (text, points, _) = self._detector.detectAndDecode(image)
+        if not text:
+            return []
+        return [Barcode(text.encode('utf-8'), 'QRCODE', cv2.boundingRect(points.astype('int32')))]
+
+
+class ZxingDecoder(Decoder):
+    name = 'zxing'
+
+    def __init__(self):
+        # optional, `pip install zxing-cpp`
+        import zxingcpp
+        self._zxing = zxingcpp
+
+    def decode(self, image):
+        barcodes = []
+        for result in self._zxing.read_barcodes(image, formats=self._zxing.BarcodeFormat.QRCode):
+            p = result.position
+            xs = [p.top_left.x, p.top_right.x, p.bottom_right.x, p.bottom_left.x]
+            ys = [p.top_left.y, p.top_right.y, p.bottom_right.y, p.bottom_left.y]
+            rect = (min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys))
+            barcodes.append(Barcode(result.text.encode('utf-8'), 'QRCODE', rect))
+        return barcodes
+
+
+DECODERS = {d.name: d for d in (PyzbarDecoder, OpenCVDecoder, ZxingDecoder)}
+
+
+def create_decoder(name='pyzbar'):
+    if name not in DECODERS:
+        raise ValueError('unknown decoder %s, use one of %s' % (name, ', '.join(DECODERS)))
+    return DECODERS[name]()
+
+
+def benchmark(directory, width=400, names=None):
+    """Runs the decoders over all images in directory, returns {name: stats}."""
+    from scanner import Preprocessor
+
+    preprocess = Preprocessor(width)
+    files = sorted(f for f in os.listdir(directory)
+                   if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')))
+    images = [preprocess(cv2.imread(os.path.join(directory, f), cv2.IMREAD_GRAYSCALE)).copy()
+              for f in files]
+
+    results = {}
+    for name in names or DECODERS:
+        try:
+            decoder = create_decoder(name)
+        except ImportError as e:
+            print('%-8s not available: %s' % (name, e))
+            continue
+
+        hits = 0
+        started = time.perf_counter()
+        for image in images:
+            if decoder(image):
+                hits += 1
+        elapsed = time.perf_counter() - started
+
+        results[name] = {
+            'frames': len(images),
+            'fps': len(images) / elapsed if elapsed else 0,
+            'hit_rate': hits / len(images) if images else 0
+        }
+        print('%-8s %6.1f frames/sec, hit rate %5.1f%% (%d/%d)' % (
+            name, results[name]['fps'], results[name]['hit_rate'] * 100, hits, len(images)))
+    return results
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Compares the QR code decoders on a directory of sample frames.')
+    arg_parser.add_argument('--benchmark', required=True,
+                            help='directory containing the sample frames (png/jpg)')
+    arg_parser.add_argument('--width', type=int, default=400,
+                            help='width the frames are scaled down to before decoding')
+    arg_parser.add_argument('--decoder', action='append', choices=list(DECODERS),
+                            help='only run this decoder (can be repeated)')
+    args = arg_parser.parse_args()
+
+    benchmark(args.benchmark, args.width, args.decoder)
@@ -1,8 +1,13 @@
-import requests
+import copy
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote, urlencode
 
-from controller import PlayController, GenerateController, TypeMode
+from controller import PlayController, GenerateController, TypeMode, traced
+from synologyapi import ApiIndex
 import logging
 
 # create logger
@@ -32,9 +37,16 @@ API_ERROR = {
     104: 'The requested version does not support the functionality',
     105: 'The logged in session does not have permission',
     106: 'Session timeout',
-    107: 'Session interrupted by duplicate login'
+    107: 'Session interrupted by duplicate login',
+    119: 'SID not found'
 }
 
+# player state after a control command
+STATES = {'play': 'playing', 'pause': 'pause', 'stop': 'stopped'}
+
+# errors after which a new login makes the request succeed
+RELOGIN_ERRORS = (106, 107, 119)
+
 
 class CGIException(Exception):
     pass
@@ -45,7 +57,9 @@ class ConsumerFactoryException(Exception):
 
 
 class SynologyException(Exception):
-    pass
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
 
 class UnknownDeviceException(Exception):
     pass
@@ -62,9 +76,9 @@ def _validate(response):
     if not rsp['success']:
         code = rsp['error']['code']
         if code in API_ERROR:
-            raise SynologyException(API_ERROR[code])
+            raise SynologyException(API_ERROR[code], code)
         else:
-            raise SynologyException('Unknown error from API (%d)' % code)
+            raise SynologyException('Unknown error from API (%d)' % code, code)
 
     if 'data' in rsp:
         return rsp['data']
@@ -72,6 +86,33 @@ def _validate(response):
     logger.debug('successfull call %s' % rsp)
 
 
+def _stream_songs(response, prefix='data.songs.item'):
+    """Yields the songs of a getplaylist response while it is being received."""
+    import ijson
+
+    if response.status_code != 200:
+        raise SynologyException('The API request cannot been made')
+
+    response.raw.decode_content = True
+    (success, code, builder) = (False, None, None)
+    for (path, event, value) in ijson.parse(response.raw):
+        if path == prefix and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+        if builder:
+            builder.event(event, value)
+            if path == prefix and event == 'end_map':
+                yield builder.value
+                builder = None
+        elif path == 'success':
+            success = value
+        elif path == 'error.code':
+            code = value
+
+    # "success" comes after "data", failures have no songs
+    if not success:
+        raise SynologyException(API_ERROR.get(code, 'Unknown error from API (%s)' % code), code)
+
+
 class DiskstationController(PlayController, GenerateController):
 
     _default_audio_device = ""
@@ -80,6 +121,7 @@ class DiskstationController(PlayController, GenerateController):
     _rooms = {
         'audio': {
             'sid': None,
+            'expires': 0,
             'session': 'AudioStation',
             'players': {},
             'playing': True,
@@ -87,6 +129,7 @@ class DiskstationController(PlayController, GenerateController):
         },
         'video': {
             'sid': None,
+            'expires': 0,
             'session': 'VideoStation',
             'players': {},
             'playing': False,
@@ -95,96 +138,275 @@ class DiskstationController(PlayController, GenerateController):
     }
 
     def __set_players(self):
-        audios = self.__get_audio_devices()
-        for player in audios['players']:
-            self._rooms['audio']['players'][player['name']] = {
+        (audio_devices, video_devices) = self.__concurrently(
+            (self.__get_audio_devices,), (self.__get_video_devices,))
+
+        audio_players = {}
+        for player in audio_devices['players']:
+            audio_players[player['name']] = {
                 'name': player['name'], 'id': player['id'], 'type': player['type']}
 
-        videos = self.__get_video_devices()
-        for player in videos['device']:
-            self._rooms['video']['players'][player['title']] = {
+        video_players = {}
+        for player in video_devices['device']:
+            video_players[player['title']] = {
                 'name': player['title'], 'id': player['id'], 'type': player['type']}
-        
-        logger.info('players set: AUDIO [%s], VIDEO [%s]', ','.join(self._rooms['audio']['players'].keys()), ','.join(self._rooms['video']['players'].keys()))
+
+        with self._players_lock:
+            self._rooms['audio']['players'] = audio_players
+            self._rooms['video']['players'] = video_players
+            self._players_updated = time.time()
+            self.__save_players()
+
+        logger.info('players set: AUDIO [%s], VIDEO [%s]', ','.join(audio_players.keys()), ','.join(video_players.keys()))
+
+    def __players_fresh(self):
+        return time.time() - self._players_updated < self.players_ttl
+
+    def __load_players(self):
+        try:
+            with open(self.players_file) as players_file:
+                cached = json.load(players_file)
+        except (OSError, ValueError):
+            return False
+
+        self._rooms['audio']['players'] = cached['audio']
+        self._rooms['video']['players'] = cached['video']
+        self._players_updated = cached['updated']
+        logger.info('players loaded from %s: AUDIO [%s], VIDEO [%s]', self.players_file,
+                    ','.join(cached['audio'].keys()), ','.join(cached['video'].keys()))
+        return True
+
+    def __save_players(self):
+        cached = {'updated': self._players_updated,
+                  'audio': self._rooms['audio']['players'],
+                  'video': self._rooms['video']['players']}
+        try:
+            with open(self.players_file + '.tmp', 'w') as players_file:
+                json.dump(cached, players_file)
+            os.replace(self.players_file + '.tmp', self.players_file)
+        except OSError as e:
+            logger.warning('could not save players to %s: %s', self.players_file, e)
+
+    def __refresh_players_async(self):
+        """Updates the players (and defaults) in the background, unless already running."""
+        if not self._players_refresh.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                self.__set_players()
+                # keep a room switched to, unless it is gone
+                for (mode, default_room) in zip((TypeMode.VIDEO, TypeMode.AUDIO), self._default_rooms):
+                    ids = [p['id'] for p in self._rooms[mode]['players'].values()]
+                    if ids and self._rooms[mode]['default'] not in ids:
+                        self.__set_default(mode, default_room)
+                # rooms switched to while the players were not known yet
+                with self._players_lock:
+                    for (mode, room) in self._pending_rooms.items():
+                        if room in self._rooms[mode]['players']:
+                            self._rooms[mode]['default'] = self._rooms[mode]['players'][room]['id']
+                            logger.info('switched %s room to \'%s\'', mode, room)
+                        else:
+                            logger.warn('cannot switch to room %s, not found ...', room)
+                    self._pending_rooms = {}
+            except Exception as e:
+                logger.warning('could not update players: %s', e)
+            finally:
+                self._players_refresh.release()
+                self._players_known.set()
+                self.__schedule_players_refresh()
+
+        threading.Thread(target=refresh, name='players', daemon=True).start()
+
+    def __schedule_players_refresh(self):
+        if self._players_timer:
+            self._players_timer.cancel()
+        delay = max(self._players_updated + self.players_ttl - time.time(), 60)
+        self._players_timer = threading.Timer(delay, self.__refresh_players_async)
+        self._players_timer.daemon = True
+        self._players_timer.start()
 
     def __set_defaults(self, default_video_room=None, default_audio_room=None):
-        if not default_video_room or default_video_room not in self._rooms['video']['players'].keys():
-            if len(self._rooms['video']['players']) > 0:
-                default = list(self._rooms['video']['players'].values())[0]
-                self._rooms['video']['default'] = default['id']
-                logger.warn('VIDEO: %s not in device list, using %s instead',
-                            default_video_room, default['name'])
-            else:
-                logger.error('no video devices found, could not set %s ',
-                            default_video_room)
-        else:
-            self._rooms['video']['default'] = self._rooms['video']['players'][default_video_room]['id']
-
-        if not default_audio_room or default_audio_room not in self._rooms['audio']['players'].keys():
-            if len(self._rooms['audio']['players']) > 0:
-                default = list(self._rooms['audio']['players'].values())[0]
-                self._rooms['audio']['default'] = default['id']
-                logger.warn('AUDIO: %s not in device list, using %s instead',
-                            default_audio_room, default['name'])
+        self.__set_default(TypeMode.VIDEO, default_video_room)
+        self.__set_default(TypeMode.AUDIO, default_audio_room)
+        logger.info('defaults set: AUDIO [%s], VIDEO [%s]', self._rooms['audio']['default'], self._rooms['video']['default'])
+
+    def __set_default(self, mode, default_room=None):
+        players = self._rooms[mode]['players']
+        if not default_room or default_room not in players.keys():
+            if len(players) > 0:
+                default = list(players.values())[0]
+                self._rooms[mode]['default'] = default['id']
+                logger.warn('%s: %s not in device list, using %s instead',
+                            mode.upper(), default_room, default['name'])
             else:
-                logger.error('no audio devices found, could not set %s ',
-                            default_audio_room)
+                logger.error('no %s devices found, could not set %s ', mode, default_room)
         else:
-            self._rooms['audio']['default'] = self._rooms['audio']['players'][default_audio_room]['id']
+            self._rooms[mode]['default'] = players[default_room]['id']
 
-        logger.info('defaults set: AUDIO [%s], VIDEO [%s]', self._rooms['audio']['default'], self._rooms['video']['default'])
-
-    def __init__(self, base_url, user, password, default_video_room=None, default_audio_room=None):
+    def __init__(self, base_url, user, password, default_video_room=None, default_audio_room=None,
+                 session_file='.synology-sessions.json', session_ttl=900,
+                 players_file='.synology-players.json', players_ttl=3600, api_ttl=0,
+                 playlist_ttl=300, workers=4, library=None, status_interval=5.0):
 
+        # the class attribute is only the template, every controller has its own rooms
+        self._rooms = copy.deepcopy(DiskstationController._rooms)
         self.user = user
         self.password = password
+        self.session_file = session_file
+        self.session_ttl = session_ttl
+        self._session_lock = threading.Lock()
+        self._auth_locks = {TypeMode.AUDIO: threading.Lock(), TypeMode.VIDEO: threading.Lock()}
+        # runs independent requests at the same time
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='diskstation')
+        self._refresh_timers = {}
+        self.players_file = players_file
+        self.players_ttl = players_ttl
+        self._players_updated = 0
+        self._players_lock = threading.Lock()
+        self._players_refresh = threading.Lock()
+        self._players_timer = None
+        self._players_known = threading.Event()
+        self._default_rooms = (default_video_room, default_audio_room)
+        # mode -> room switched to during the players discovery, see switch_room()
+        self._pending_rooms = {}
+        self.playlist_ttl = playlist_ttl
+        # LibraryIndex the lookups try first, see sync_library()
+        self.library = library
+        # device -> (songs in the queue, when that was counted, when the queue was changed)
+        self._playlists = {}
+        self._playlists_lock = threading.Lock()
+        self.status_interval = status_interval
+        # mode -> {'state', 'title', 'artist', 'updated', 'commanded'} as last seen on the player
+        self._status = {TypeMode.AUDIO: {'updated': 0, 'commanded': 0},
+                        TypeMode.VIDEO: {'updated': 0, 'commanded': 0}}
+        self._status_lock = threading.Lock()
         super().__init__(base_url, "diskstation")
-        with open('synology-api.json') as json_file:
-            d = json.load(json_file)
-            self.api_paths = d['data']
-
-        self.__set_players()
-        try:
-            self.__set_defaults(default_video_room, default_audio_room)
-        except:
-            logger.error('could net set defaults: %s, %s',
-                         default_video_room, default_audio_room)
+        self.__load_sessions()
+        # API paths, loaded on first use
+        self.api = ApiIndex()
+        if api_ttl and (self.api.cache_age() is None or self.api.cache_age() > api_ttl):
+            threading.Thread(target=self.__refresh_api, name='api', daemon=True).start()
+
+        # start with the cached players (if any) and update them in the background
+        if self.__load_players():
+            try:
+                self.__set_defaults(default_video_room, default_audio_room)
+            except:
+                logger.error('could net set defaults: %s, %s',
+                             default_video_room, default_audio_room)
+        if self.__players_fresh():
+            self._players_known.set()
+            self.__schedule_players_refresh()
+        else:
+            self.__refresh_players_async()
         self.current_mode = TypeMode.VIDEO
 
-    def __get_playing_devices(self):
-        if self._rooms[self.current_mode]['playing']:
-            logger.debug('current mode(%s) playing, stop %s ... ',self.current_mode, self._rooms[self.current_mode]['default'])
-            return list(self._rooms[self.current_mode]['default'])
+        if status_interval:
+            threading.Thread(target=self.__poll_status, name='player-status', daemon=True).start()
 
-        logger.warning('nothing playing in mode %s, check other mode ... ', self.current_mode)
-        self.switch_mode(TypeMode.AUDIO if self.current_mode == TypeMode.VIDEO else TypeMode.VIDEO)
+    def wait_players(self, timeout=None):
+        """Waits for the players discovery started by the constructor, False on timeout."""
+        return self._players_known.wait(timeout)
 
-        modes_playing = {k: v for k, v in self._rooms.items() if v['playing']}
-        
-        return list(map(lambda m: m['default'], modes_playing.values()))
-        
+    def __refresh_api(self):
+        try:
+            self.api.refresh(self.transport, self.base_url, self.namespace)
+        except Exception as e:
+            logger.warning('could not refresh API paths: %s', e)
 
     def auth(self, session=None):
         if not session:
             session = self._rooms[self.current_mode]['session']
+        mode = self.__session_mode(session)
         payload = {'api': 'SYNO.API.Auth', 'version': 2, 'method': 'login',
                    'account': self.user, 'passwd': self.password, 'session': session}
-        response = requests.get(self.base_url + '/auth.cgi', params=payload)
+        response = self.transport.get(self.base_url + '/auth.cgi', params=payload,
+                                      backend=self.namespace, api='SYNO.API.Auth')
         data = _validate(response)
         logger.debug('auth succeeded for %s ' % session)
-        self._rooms[self.current_mode]['sid'] = data['sid']
+
+        with self._session_lock:
+            self._rooms[mode]['sid'] = data['sid']
+            self._rooms[mode]['expires'] = time.time() + self.session_ttl
+            self.__save_sessions()
+        # login again in the background before the session runs out
+        self.__schedule_refresh(mode, self.session_ttl * 0.8)
         return data['sid']
 
+    def __session_mode(self, session):
+        for (mode, room) in self._rooms.items():
+            if room['session'] == session:
+                return mode
+        raise SynologyException('unknown session: ' + session)
+
+    def __load_sessions(self):
+        try:
+            with open(self.session_file) as session_file:
+                sessions = json.load(session_file)
+        except (OSError, ValueError):
+            return
+
+        now = time.time()
+        for (mode, room) in self._rooms.items():
+            cached = sessions.get(room['session'])
+            if cached and cached['expires'] > now:
+                room['sid'] = cached['sid']
+                room['expires'] = cached['expires']
+                self.__schedule_refresh(mode, (cached['expires'] - now) * 0.8)
+                logger.info('reusing %s session, valid for %ds', room['session'], cached['expires'] - now)
+
+    def __save_sessions(self):
+        sessions = {room['session']: {'sid': room['sid'], 'expires': room['expires']}
+                    for room in self._rooms.values() if room['sid']}
+        try:
+            # the session ids are as good as the password, only readable by the owner
+            fd = os.open(self.session_file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # a .tmp left over from before keeps its mode
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w') as session_file:
+                json.dump(sessions, session_file)
+            os.replace(self.session_file + '.tmp', self.session_file)
+        except OSError as e:
+            logger.warning('could not save sessions to %s: %s', self.session_file, e)
+
+    def __schedule_refresh(self, mode, delay):
+        if mode in self._refresh_timers:
+            self._refresh_timers[mode].cancel()
+        timer = threading.Timer(delay, self.__refresh_session, [mode])
+        timer.daemon = True
+        timer.start()
+        self._refresh_timers[mode] = timer
+
+    def __refresh_session(self, mode):
+        try:
+            with self._auth_locks[mode]:
+                # a re-login after a lost session may have renewed it meanwhile
+                if self._rooms[mode]['expires'] - time.time() > self.session_ttl * 0.5:
+                    return
+                self.auth(self._rooms[mode]['session'])
+            logger.info('refreshed %s session', self._rooms[mode]['session'])
+        except Exception as e:
+            logger.warning('could not refresh %s session, trying again in a minute: %s',
+                           self._rooms[mode]['session'], e)
+            self.__schedule_refresh(mode, 60)
+
     def switch_room(self, room, mode=None, need_to_quote=True):
         if mode:
             self.switch_mode(mode)            
         try:
             #self.__check_room(room, mode)
 
-            if room in list(self._rooms[self.current_mode]['players'].keys()):
-                self._rooms[self.current_mode]['default'] = self._rooms[self.current_mode]['players'][room]['id']
-            else:
-                logger.warn('cannot switch to room %s, not found ...', room)
+            with self._players_lock:
+                if room in list(self._rooms[self.current_mode]['players'].keys()):
+                    self._rooms[self.current_mode]['default'] = self._rooms[self.current_mode]['players'][room]['id']
+                elif self._players_refresh.locked():
+                    # applied once the players are known
+                    self._pending_rooms[self.current_mode] = room
+                    logger.info('room %s not known yet, switching once the players are found', room)
+                    return
+                else:
+                    logger.warn('cannot switch to room %s, not found ...', room)
             if need_to_quote:
                 logger.warning("controller is encoding at request time ...")
         except SynologyException as se:
@@ -204,40 +426,137 @@ class DiskstationController(PlayController, GenerateController):
         if not mode:
             mode = self.current_mode
 
+        if cmd not in ['pause','play','stop','next','prev']:
+            return 'Hmm, I don\'t recognize that command : %s' % cmd
+
+        if cmd != 'stop':
+            return self.__control(cmd, mode)
+
+        # stop whatever plays, at the same time, and leave idle players alone
+        modes = [m for m in (TypeMode.AUDIO, TypeMode.VIDEO)
+                 if self._rooms[m]['default'] and self.__active(m, m == mode)]
+        if not modes:
+            logger.info('nothing playing, nothing to stop')
+            return None
+        logger.info('stopping %s', [self._rooms[m]['default'] for m in modes])
+        return self.__concurrently(*[(self.__control, cmd, m) for m in modes])[0]
+
+    def __control(self, cmd, mode):
         if mode == TypeMode.AUDIO:            
             params = {
                 'api': "SYNO.AudioStation.RemotePlayer",
                 'method': 'control',
                 'id': self._rooms[mode]['default'],
                 'version': 2,
-                'action': 'pause',
+                'action': cmd,
                 'value': 0
             }
-            key='action'
             path="AudioStation/remote_player.cgi"
         else:
             params = {
                 "api": "SYNO.VideoStation2.Controller.Playback",
-                "method": "pause",
+                "method": cmd,
                 "version": 2
             }
-            key='method'
             path='entry.cgi'
 
-        if cmd in ['pause','play','stop','next','prev']:             
-            params[key] = cmd
-            result = self.perform_room_request(path, params)            
-            if cmd == 'stop':
-                self._rooms[mode]['playing'] = False
-                other_devices = self.__get_playing_devices()
-                if len(other_devices) > 0:
-                    logger.info('stop other devices as well ... %s', other_devices)
-                    self.__execute_command('stop', TypeMode.AUDIO if mode == TypeMode.VIDEO else TypeMode.VIDEO)                    
-                    
-            return result
-        else:       
-            return 'Hmm, I don\'t recognize that command : %s' % cmd
-
+        params['device_id'] = self._rooms[mode]['default']
+        result = self.perform_request(path, params, mode)
+        if cmd in STATES:
+            self.__set_status(mode, state=STATES[cmd])
+        return result
+
+    def __active(self, mode, default):
+        """Whether the player of mode plays (or pauses), `default` if that is not known."""
+        status = self.__fresh_status(mode)
+        if status:
+            return status['state'] in ('playing', 'pause')
+        return self._rooms[mode]['playing'] or default
+
+    def __fresh_status(self, mode):
+        """The mirrored status of mode if the poller updated it lately, otherwise None."""
+        with self._status_lock:
+            status = dict(self._status[mode])
+        if self.status_interval and time.time() - status['updated'] < 3 * self.status_interval:
+            return status
+        return None
+
+    def __set_status(self, mode, since=None, **status):
+        """
+        Updates the mirror with what a poll sent at `since` saw, unless a command
+        changed the player after that.  Without `since` the status comes from
+        our own command, which does not make the mirror any fresher.
+        """
+        with self._status_lock:
+            if since is None:
+                status['commanded'] = time.time()
+            elif self._status[mode]['commanded'] > since:
+                logger.debug('dropped the %s status asked for before the last command', mode)
+                return
+            else:
+                status['updated'] = time.time()
+            self._status[mode].update(status)
+            self._rooms[mode]['playing'] = self._status[mode]['state'] in ('playing', 'pause')
+
+    def now_playing(self, mode=None):
+        """The mirrored status of the player of mode, without asking the NAS."""
+        with self._status_lock:
+            return dict(self._status[mode or self.current_mode])
+
+    def __poll_status(self):
+        while True:
+            modes = [m for m in (TypeMode.AUDIO, TypeMode.VIDEO) if self._rooms[m]['default']]
+            try:
+                self.__concurrently(*[(self.__update_status, m) for m in modes])
+            except Exception as e:
+                logger.debug('could not update the player status: %s', e)
+            time.sleep(self.status_interval)
+
+    def __update_status(self, mode):
+        device = self._rooms[mode]['default']
+        sent = time.time()
+        if mode == TypeMode.AUDIO:
+            status = self.perform_request('AudioStation/remote_player_status.cgi', {
+                'api': 'SYNO.AudioStation.RemotePlayerStatus',
+                'method': 'getstatus',
+                'id': device,
+                'additional': 'song_tag',
+                'version': 1
+            }, mode)
+            if status.get('playlist_total') is not None:
+                self.__playlist_changed(device, status['playlist_total'], since=sent)
+            song = status.get('song') or {}
+            self.__set_status(mode, sent, state=status.get('state'), title=song.get('title'),
+                              artist=song.get('additional', {}).get('song_tag', {}).get('artist'))
+        else:
+            status = self.perform_request('entry.cgi', {
+                'api': 'SYNO.VideoStation2.Controller.Playback',
+                'method': 'status',
+                'device_id': device,
+                'version': 2
+            }, mode)
+            self.__set_status(mode, sent, state=status.get('state'), title=status.get('title'),
+                              artist=None)
+
+    def __concurrently(self, *calls):
+        """Runs the (function, *args) calls in parallel, returns their results in order."""
+        if len(calls) == 1:
+            (function, *args) = calls[0]
+            return [function(*args)]
+        futures = [self._pool.submit(self.transport.bind(function), *args)
+                   for (function, *args) in calls]
+        return [future.result() for future in futures]
+
+    def sync_library(self, max_age=0):
+        """Updates the parts of the local library index older than max_age seconds."""
+        if self.library:
+            self.library.sync(self.perform_request, max_age)
+
+    def get_library_tracks(self, uris):
+        """get_library_track() for each of uris, looked up in parallel."""
+        return list(self._pool.map(self.transport.bind(self.get_library_track), uris))
+
+    @traced
     def handle_command(self, qrcode):
         
         try:
@@ -247,6 +566,18 @@ class DiskstationController(PlayController, GenerateController):
 
             logger.info('Command execution \'%s\' on %s', cmd, self._rooms[self.current_mode]['default'])
 
+            if cmd == 'whatsong':
+                status = self.__fresh_status(self.current_mode)
+                if not status or (status.get('state') == 'playing' and not status.get('title')):
+                    # not polled (lately) or not since we started something, ask the player
+                    self.__update_status(self.current_mode)
+                    status = self.now_playing()
+                if status.get('state') != 'playing' or not status.get('title'):
+                    return 'Nothing is playing'
+                if status.get('artist'):
+                    return '%s by %s' % (status['title'], status['artist'])
+                return status['title']
+
             if cmd == 'clear':
                 if self.current_mode == TypeMode.AUDIO:
                     return self.clear_audio()                
@@ -259,28 +590,83 @@ class DiskstationController(PlayController, GenerateController):
             logger.error(se)
         
 
-    def perform_request(self, path, payload):
+    def perform_request(self, path, payload, mode=None, stream=False):
         if not payload:
             payload = {}
+        if not mode:
+            mode = self.current_mode
 
-        if not '_sid' in payload:
-            if not self._rooms[self.current_mode]['sid']:
-                logger.info("need to auth first for %s ...", self.current_mode)
-                self.auth(self._rooms[self.current_mode]['session'])
-
-            payload['_sid'] = self._rooms[self.current_mode]['sid']
+        session = self._rooms[mode]['session']
+        own_session = not '_sid' in payload
+        if own_session:
+            payload['_sid'] = self.__sid(mode)
 
         if not path:
             if payload['api']:
                 api = payload['api']
-                path = self.api_paths[api]['path']
+                path = self.api.path(api)
 
+        if stream:
+            return self.__stream(path, payload, session, own_session)
+
+        try:
+            return self.__send(path, payload)
+        except SynologyException as se:
+            if not own_session or se.code not in RELOGIN_ERRORS:
+                raise
+            # the (cached) session ran out or was replaced, login and try once more
+            logger.info('%s session lost (%s), login again ...', session, se)
+            payload['_sid'] = self.__relogin(mode, payload['_sid'])
+            return self.__send(path, payload)
+
+    def __sid(self, mode):
+        if not self._rooms[mode]['sid']:
+            with self._auth_locks[mode]:
+                # a concurrent request may have logged in meanwhile
+                if not self._rooms[mode]['sid']:
+                    logger.info("need to auth first for %s ...", mode)
+                    self.auth(self._rooms[mode]['session'])
+        return self._rooms[mode]['sid']
+
+    def __relogin(self, mode, lost_sid):
+        with self._auth_locks[mode]:
+            # parallel requests that lost the same session login only once
+            if self._rooms[mode]['sid'] in (None, lost_sid):
+                self.auth(self._rooms[mode]['session'])
+        return self._rooms[mode]['sid']
+
+    def __send(self, path, payload, stream=False):
         params = urlencode(payload, quote_via=quote)
-        response = requests.get(self.base_url + '/' + path, params=params)
+        response = self.transport.get(self.base_url + '/' + path, params=params,
+                                      backend=self.namespace, api=payload.get('api', path),
+                                      stream=stream)
 
         logger.debug('URL: %s  ->%s', response.url, response.status_code)
+        if stream:
+            return response
         return _validate(response)
 
+    def __stream(self, path, payload, session, own_session):
+        response = self.__send(path, payload, True)
+        try:
+            yield from _stream_songs(response)
+            return
+        except SynologyException as se:
+            # a failed answer carries no songs, so nothing was yielded yet
+            if not own_session or se.code not in RELOGIN_ERRORS:
+                raise
+            lost = se
+        finally:
+            response.close()
+
+        logger.info('%s session lost (%s), login again ...', session, lost)
+        payload['_sid'] = self.__relogin(self.__session_mode(session), payload['_sid'])
+        response = self.__send(path, payload, True)
+        try:
+            yield from _stream_songs(response)
+        finally:
+            response.close()
+
     def __check_room(self, device = None, mode = None):
         if not mode :
             mode = self.current_mode
@@ -290,7 +676,11 @@ class DiskstationController(PlayController, GenerateController):
         all_devices = [ p['id'] for p in self._rooms[mode]['players'].values() ]
          
         if not device in all_devices :
-            logger.warn('%s device \'%s\' not known, currently available: %s', 'AUDIO' if mode == TypeMode.AUDIO else 'VIDEO', device, ','.join(all_devices.keys()) if len(all_devices)>0 else 'NONE')
+            logger.warn('%s device \'%s\' not known, currently available: %s', 'AUDIO' if mode == TypeMode.AUDIO else 'VIDEO', device, ','.join(all_devices) if len(all_devices)>0 else 'NONE')
+            if self.__players_fresh():
+                # do not make the card wait for discovery, the next one will know
+                self.__refresh_players_async()
+                raise UnknownDeviceException('%s (%s)' % (device, mode ))
             self.__set_players()
             all_devices =  [ p['id'] for p in self._rooms[mode]['players'].values()]
             if not device in all_devices:
@@ -319,7 +709,6 @@ class DiskstationController(PlayController, GenerateController):
         return self.perform_request(path, payload)
 
     def get_episode(self, id, show_id):
-        self.current_mode = TypeMode.VIDEO
         params = {
             'api': 'SYNO.VideoStation2.TVShowEpisode',
             'version': 1,
@@ -330,19 +719,22 @@ class DiskstationController(PlayController, GenerateController):
             'library_id': '0',
             'id': '[' + id + ']'
         }
-        result = self.perform_request('entry.cgi', params)
-        episode = result['episode'][0]
-        file_id = episode['additional']['file'][0]['id']
+        episode = self.library.episode(id) if self.library else None
+        if episode is None:
+            result = self.perform_request('entry.cgi', params, TypeMode.VIDEO)
+            episode = result['episode'][0]
+            episode['file_id'] = episode['additional']['file'][0]['id']
+        file_id = episode['file_id']
         return {
             'song': episode['tagline'],
             'album': episode['title'],
-            'arturl': self.base_url+'/entry.cgi?type=tvshow&id='+show_id+'&api=SYNO.VideoStation2.Poster&method=get&version=1&resolution='+'%2'+'22x%22&_sid='+self._rooms[self.current_mode]['sid'],
+            'artkey': 'dsvideo:tvshow:' + show_id,
+            'arturl': self.base_url+'/entry.cgi?type=tvshow&id='+show_id+'&api=SYNO.VideoStation2.Poster&method=get&version=1&resolution='+'%2'+'22x%22&_sid='+self.__sid(TypeMode.VIDEO),
             'data': 'dsvideo:{"api": "SYNO.VideoStation2.Controller.Playback", "method": "play",' +
             '"file_id": %s, "playback_target": "file_id", "version": 2}' % file_id
         }
 
     def get_movie(self, id):
-        self.current_mode = TypeMode.VIDEO
         params = {
             'api': 'SYNO.VideoStation2.Movie',
             'version': 1,
@@ -350,22 +742,24 @@ class DiskstationController(PlayController, GenerateController):
             'additional': '["file","extra"]',
             'id': '[' + id + ']'
         }
-        result = self.perform_request('entry.cgi', params)
-        movie = result['movie'][0]
-        file_id = movie['additional']['file'][0]['id']
+        movie = self.library.movie(id) if self.library else None
+        if movie is None:
+            result = self.perform_request('entry.cgi', params, TypeMode.VIDEO)
+            movie = result['movie'][0]
+            movie['file_id'] = movie['additional']['file'][0]['id']
+        file_id = movie['file_id']
         (title, subtitle) = movie['title'].split('-')
         return {
             'song': title.strip(),
             'album': subtitle.strip() if subtitle else None,
-            'arturl': self.base_url+'/entry.cgi?type=movie&id='+id+'&api=SYNO.VideoStation2.Poster&method=get&version=1&resolution=%222x%22&_sid='+self._rooms[self.current_mode]['sid'],
+            'artkey': 'dsvideo:movie:' + id,
+            'arturl': self.base_url+'/entry.cgi?type=movie&id='+id+'&api=SYNO.VideoStation2.Poster&method=get&version=1&resolution=%222x%22&_sid='+self.__sid(TypeMode.VIDEO),
             'data': 'dsvideo:{"api": "SYNO.VideoStation2.Controller.Playback", "method": "play",' +
             '"file_id": %s, "playback_target": "file_id", "version": 2}' % file_id
         }
 
     def get_song(self, id):
 
-        self.current_mode = TypeMode.AUDIO
-
         payload = {
             'api': 'SYNO.AudioStation.Song',
             'version': 3,
@@ -374,9 +768,12 @@ class DiskstationController(PlayController, GenerateController):
             'id': id,
             'library_id': '0'
         }
-        
-        result = self.perform_request('AudioStation/song.cgi', payload)
-        song = result['songs'][0]
+
+        song = self.library.song(id) if self.library else None
+        if song is None:
+            result = self.perform_request('AudioStation/song.cgi', payload, TypeMode.AUDIO)
+            song = result['songs'][0]
+            song.update(song['additional']['song_tag'])
         queryParams=urlencode({'api': 'SYNO.AudioStation.Cover',
                                  'output_default': 'true',
                                  'version': 3,
@@ -384,21 +781,20 @@ class DiskstationController(PlayController, GenerateController):
                                  'method': 'getsongcover',
                                  'view': 'default',
                                  'id': id,
-                                 '_sid': self._rooms[self.current_mode]['sid']
+                                 '_sid': self.__sid(TypeMode.AUDIO)
                                  }, quote_via = quote)
 
         return {
             'song': song['title'],
-            'album': song['additional']['song_tag']['album'],
-            'artist':song['additional']['song_tag']['artist'],
+            'album': song['album'],
+            'artist':song['artist'],
+            'artkey': 'dsaudio:song:' + id,
             'arturl': self.base_url+'/AudioStation/cover.cgi?'+queryParams,
             'data': 'dsaudio:music_id='+id
         }
 
     def get_album(self, album, album_artist, artist=None):
 
-        self.current_mode = TypeMode.AUDIO
-
         payload = {
             'limit': 1000,
             'method': 'list',
@@ -411,14 +807,14 @@ class DiskstationController(PlayController, GenerateController):
         }
         if artist:
             payload['artist'] = artist
-        result = self.perform_request('AudioStation/album.cgi', payload)
-        
 
-        matchedAlbum = None
-        for x in result['albums']:
-            if x['name'].lower() == album.lower():
-                matchedAlbum = x
-                break
+        matchedAlbum = self.library.album(album, album_artist) if self.library else None
+        if matchedAlbum is None:
+            result = self.perform_request('AudioStation/album.cgi', payload, TypeMode.AUDIO)
+            for x in result['albums']:
+                if x['name'].lower() == album.lower():
+                    matchedAlbum = x
+                    break
 
         if not matchedAlbum:
             raise SynologyException('no album for ' + album)
@@ -435,21 +831,20 @@ class DiskstationController(PlayController, GenerateController):
                                  'view': 'default',
                                  'album_name': album,
                                  'album_artist_name': album_artist,
-                                 '_sid': self._rooms[self.current_mode]['sid']
+                                 '_sid': self.__sid(TypeMode.AUDIO)
                                  }, quote_via=quote)
 
         return {
             'song': album,
             'album': album_artist,
             'artist': artist,
+            'artkey': 'dsaudio:album:%s|%s' % (album, album_artist),
             'arturl': self.base_url+'/AudioStation/cover.cgi?'+queryParams,
             'data': 'dsaudio:[{"type":"album","sort_by":"name","sort_direction":"ASC","album":"%s", "album_artist":"%s"}]' % (album, album_artist)
         }
 
     def get_artist(self, artist=""):
 
-        self.current_mode = TypeMode.AUDIO
-
         payload = {
             'limit': 1000,
             'method': 'list',
@@ -459,12 +854,13 @@ class DiskstationController(PlayController, GenerateController):
             'additional': '["file","song","extra"]',
             'version': 3,
         }
-        result = self.perform_request('AudioStation/artist.cgi', payload)
-        matchedArtist = None
-        for x in result['artists']:
-            if x['name'].lower() == artist.lower():
-                matchedArtist = x
-                break
+        matchedArtist = self.library.artist(artist) if self.library else None
+        if matchedArtist is None:
+            result = self.perform_request('AudioStation/artist.cgi', payload, TypeMode.AUDIO)
+            for x in result['artists']:
+                if x['name'].lower() == artist.lower():
+                    matchedArtist = x
+                    break
 
         if not matchedArtist:
             raise SynologyException('no artist for ' + artist)
@@ -478,15 +874,17 @@ class DiskstationController(PlayController, GenerateController):
                                  'method': 'getcover',
                                  'view': 'default',
                                  'artist_name': artist,
-                                 '_sid': self._rooms[self.current_mode]['sid']
+                                 '_sid': self.__sid(TypeMode.AUDIO)
                                  }, quote_via=quote)
 
         return {
             'song': artist,
+            'artkey': 'dsaudio:artist:' + artist,
             'arturl': self.base_url+'/AudioStation/cover.cgi?'+queryParams,
             'data': 'dsaudio:[{"type":"artist","sort_by":"name","sort_direction":"ASC","artist":"%s"}]' % artist
         }
 
+    @traced
     def get_library_track(self, uri):
         dsMode, dsData = uri[:7], uri[8:]
         data = dict(item.strip().split('=') for item in dsData.split('|'))
@@ -515,8 +913,9 @@ class DiskstationController(PlayController, GenerateController):
 
     def clear_audio(self, limit=None):
         self.current_mode = TypeMode.AUDIO
+        device = self._rooms[self.current_mode]['default']
         if not limit:
-            limit = self.get_current_playlist()['total']
+            limit = self.__playlist_size(device)
 
         paramsClean = {
             'api': 'SYNO.AudioStation.RemotePlayer', 
@@ -528,8 +927,14 @@ class DiskstationController(PlayController, GenerateController):
             'updated_index': '-1',
             'version': 3
             }
-        self.perform_room_request("AudioStation/remote_player.cgi", paramsClean)
+        try:
+            self.perform_room_request("AudioStation/remote_player.cgi", paramsClean)
+        except SynologyException:
+            self.__playlist_changed(device, None)
+            raise
+        self.__playlist_changed(device, 0, derived=True)
 
+    @traced
     def play_video(self, path, payload=None):
         if not payload:
             payload = {}
@@ -545,22 +950,34 @@ class DiskstationController(PlayController, GenerateController):
             self.__check_room(payload['device_id'], TypeMode.VIDEO)    
 
             result = self.perform_room_request(path, payload)
-            self._rooms['video']['playing'] = True
+            self.__set_status(TypeMode.VIDEO, state='playing', title=None, artist=None)
             return result
         except (SynologyException, UnknownDeviceException) as se:
             logger.error(se)
         
 
+    @traced
     def play_audio(self, containers_json):
+        """Replaces the queue of the default audio device and starts playing it."""
         self.current_mode = TypeMode.AUDIO
-        
-        try:
-            self.__check_room(self._rooms[self.current_mode]['default'], TypeMode.AUDIO)    
+        device = self._rooms[TypeMode.AUDIO]['default']
 
-            self.load_audio(containers_json)        
-
-            result = self.handle_command('cmd:play')
-            self._rooms['audio']['playing'] = True
+        try:
+            self.__check_room(device, TypeMode.AUDIO)
+
+            # overwriting the whole queue with play=true also starts playback,
+            # no separate control call needed
+            payload = self.__playlist_payload(device, containers_json)
+            payload.update({'offset': 0, 'limit': self.__playlist_size(device), 'play': 'true'})
+            try:
+                result = self.perform_request('AudioStation/remote_player.cgi', payload, TypeMode.AUDIO)
+            except SynologyException:
+                # maybe the queue was changed elsewhere, count it next time
+                self.__playlist_changed(device, None)
+                raise
+            # a single song is known, containers have to be counted next time
+            self.__playlist_changed(device, 1 if 'songs' in payload else None, derived=True)
+            self.__set_status(TypeMode.AUDIO, state='playing', title=None, artist=None)
             return result
 
         except (SynologyException, UnknownDeviceException) as se:
@@ -569,37 +986,81 @@ class DiskstationController(PlayController, GenerateController):
 
     def load_audio(self, containers_json): 
         self.current_mode = TypeMode.AUDIO
-        song = None
+        device = self._rooms[TypeMode.AUDIO]['default']
 
         try:
-            self.__check_room(self._rooms[self.current_mode]['default'], TypeMode.AUDIO)    
-
-            if containers_json.startswith('music_'):
-                song = containers_json
-                containers_json = '[]'
-
-            payloadLoad = {
-                'api': 'SYNO.AudioStation.RemotePlayer',
-                'method': 'updateplaylist',
-                'library': 'shared',
-                'id': self._rooms[self.current_mode]['default'],
-                'offset': -1,
-                'limit': 0,
-                'play': 'false',
-                'version': 3,
-                'keep_shuffle_order': 'false',
-                'containers_json': containers_json
-            }
-            if song:
-                payloadLoad['songs']=song
-
-            return self.perform_request('AudioStation/remote_player.cgi', payloadLoad)
+            self.__check_room(device, TypeMode.AUDIO)
+
+            payload = self.__playlist_payload(device, containers_json)
+            payload.update({'offset': -1, 'limit': 0, 'play': 'false'})
+            result = self.perform_request('AudioStation/remote_player.cgi', payload, TypeMode.AUDIO)
+            total = self.__playlist_total(device)
+            self.__playlist_changed(device, total + 1 if 'songs' in payload and total is not None else None,
+                                    derived=True)
+            return result
 
         except (SynologyException, UnknownDeviceException) as se:
             logger.error(se)
+
+    def __playlist_payload(self, device, containers_json):
+        song = None
+        if containers_json.startswith('music_'):
+            song = containers_json
+            containers_json = '[]'
+
+        payload = {
+            'api': 'SYNO.AudioStation.RemotePlayer',
+            'method': 'updateplaylist',
+            'library': 'shared',
+            'id': device,
+            'version': 3,
+            'keep_shuffle_order': 'false',
+            'containers_json': containers_json
+        }
+        if song:
+            payload['songs'] = song
+        return payload
+
+    def __playlist_total(self, device):
+        """The number of songs in the queue of device as tracked locally, None if unsure."""
+        with self._playlists_lock:
+            (total, known, _) = self._playlists.get(device, (None, 0, 0))
+        if time.time() - known > self.playlist_ttl:
+            return None
+        return total
+
+    def __playlist_changed(self, device, total, derived=False, since=None):
+        """
+        Notes the number of songs in the queue of device, None if unknown.
+
+        A total derived from the tracked one (e.g. one song added) keeps its
+        age, so a wrong count does not live on while cards are scanned.  A
+        total counted on the NAS, asked for at `since`, is ignored if the
+        queue was changed (or counted) after that.
+        """
+        now = time.time()
+        with self._playlists_lock:
+            (_, known, changed) = self._playlists.get(device, (None, 0, 0))
+            if since is not None:
+                if since >= max(known, changed):
+                    self._playlists[device] = (total, since, changed)
+            elif total is None:
+                self._playlists[device] = (None, 0, now)
+            else:
+                self._playlists[device] = (total, known if derived else now, now)
+
+    def __playlist_size(self, device):
+        total = self.__playlist_total(device)
+        if total is None:
+            # only the total, without any songs
+            sent = time.time()
+            total = self.get_current_playlist(device, limit=0, additional=None)['total']
+            self.__playlist_changed(device, total, since=sent)
+        return total
        
 
-    def get_current_playlist(self, device=None):
+    def get_current_playlist(self, device=None, limit=8192,
+                             additional='song_tag,song_audio,song_rating'):
 
         if not device:
             device = self._rooms[self.current_mode]['default']
@@ -611,33 +1072,62 @@ class DiskstationController(PlayController, GenerateController):
             'api': 'SYNO.AudioStation.RemotePlayer',
             'method': 'getplaylist',
             'id': device, 
-            'additional': 'song_tag,song_audio,song_rating',
             'offset': 0,
-            'limit': 8192,
+            'limit': limit,
             'version': 3
         }     
+        if additional:
+            payload['additional'] = additional
         return self.perform_request(
-            'AudioStation/remote_player.cgi', payload)   
+            'AudioStation/remote_player.cgi', payload, TypeMode.AUDIO)
+
+    def iter_current_playlist(self, device=None, additional='song_tag,song_audio,song_rating'):
+        """
+        Yields the songs in the queue of device.
+
+        With ijson installed the (possibly huge) answer is parsed while it
+        arrives instead of being loaded as a whole.
+        """
+        try:
+            import ijson
+        except ImportError:
+            yield from self.get_current_playlist(device, additional=additional)['songs']
+            return
+
+        if not device:
+            device = self._rooms[TypeMode.AUDIO]['default']
+        total = 0
+        sent = time.time()
+        for song in self.perform_request('AudioStation/remote_player.cgi', {
+                'api': 'SYNO.AudioStation.RemotePlayer',
+                'method': 'getplaylist',
+                'id': device[5:] if device.startswith('upnp') else device,
+                'additional': additional,
+                'offset': 0,
+                'limit': 8192,
+                'version': 3
+        }, TypeMode.AUDIO, stream=True):
+            total += 1
+            yield song
+        self.__playlist_changed(device, total, since=sent)
 
     def __get_audio_devices(self):
-        self.current_mode = TypeMode.AUDIO
         payload = {
             'api': 'SYNO.AudioStation.RemotePlayer',
             'version': 2,
             'method': 'list'
         }
         return self.perform_request(
-            'AudioStation/remote_player.cgi', payload)
+            'AudioStation/remote_player.cgi', payload, TypeMode.AUDIO)
 
     def __get_video_devices(self):
-        self.current_mode = TypeMode.VIDEO
         payload = {
             'api': 'SYNO.VideoStation2.Controller.Device',
             'version': 1,
             'method': 'list',
             'limit': 500
         }
-        return self.perform_request('entry.cgi', payload)
+        return self.perform_request('entry.cgi', payload, TypeMode.VIDEO)
 
 # ??
     def add_playlist(self, playlist, offset=-1):
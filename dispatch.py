@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from metrics import metrics
+
+# create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to info
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(lineno)s:%(funcName)s - %(message)s'))
+logger.addHandler(ch)
+
+
+class DispatchExecutor:
+    """
+    Runs (controller) actions one after another in a background thread.
+
+    An action submitted with a `key` replaces a pending, not yet started
+    action with the same key, so when several cards are swapped quickly only
+    the newest one is played.  Actions without a key are never dropped.
+    """
+
+    def __init__(self, name='executor'):
+        self.name = name
+        self.coalesced = 0
+        # (key, submitted, action, args)
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._running = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=2.0):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def wait(self, timeout=None):
+        """Blocks until every submitted action ran (or was superseded)."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and not self._running,
+                                            timeout)
+
+    def qsize(self):
+        with self._condition:
+            return len(self._pending)
+
+    def submit(self, action, *args, key=None):
+        with self._condition:
+            if key is not None:
+                for item in [p for p in self._pending if p[0] == key]:
+                    self._pending.remove(item)
+                    self.coalesced += 1
+                    logger.info('%s%s superseded before it started', item[2].__name__, item[3])
+            self._pending.append((key, time.monotonic(), action, args))
+            depth = len(self._pending)
+            self._condition.notify_all()
+        logger.debug('queued %s%s, %d pending', action.__name__, args, depth)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                (key, submitted, action, args) = self._pending.popleft()
+                depth = len(self._pending)
+                self._running = True
+
+            started = time.monotonic()
+            try:
+                action(*args)
+            except Exception:
+                logger.exception('%s%s failed', action.__name__, args)
+            finally:
+                metrics.observe('qrocodile_stage_seconds', time.monotonic() - started,
+                                stage='dispatch')
+                metrics.observe('qrocodile_stage_seconds', started - submitted,
+                                stage='dispatch_wait')
+                logger.info('%s%s took %.0fms after waiting %.0fms, %d pending',
+                            action.__name__, args, (time.monotonic() - started) * 1000,
+                            (started - submitted) * 1000, depth)
+                with self._condition:
+                    self._running = False
+                    self._condition.notify_all()
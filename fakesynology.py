@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+# create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to info
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(lineno)s:%(funcName)s - %(message)s'))
+logger.addHandler(ch)
+
+
+AUDIO_PLAYER = {'name': 'QRocodile', 'id': 'uuid:qrocodile', 'type': 'upnp'}
+VIDEO_DEVICE = {'title': 'TV', 'id': 'tv', 'type': 'chromecast'}
+
+# player state after a control command
+STATES = {'play': 'playing', 'pause': 'pause', 'stop': 'stopped'}
+
+# errors after which the session is gone
+SESSION_ERRORS = (106, 107)
+
+
+class Library:
+    """A generated AudioStation/VideoStation library of about `size` songs."""
+
+    def __init__(self, size=1000):
+        self.songs = [{'id': 'music_%d' % i, 'title': 'Song %d' % i, 'path': '/music/%d.mp3' % i,
+                       'additional': {'song_tag': {'album': 'Album %d' % (i // 10),
+                                                   'artist': 'Artist %d' % (i // 50),
+                                                   'album_artist': 'Artist %d' % (i // 50)}}}
+                      for i in range(size)]
+        self.albums = [{'name': 'Album %d' % a, 'album_artist': 'Artist %d' % (a // 5),
+                        'artist': 'Artist %d' % (a // 5), 'display_artist': 'Artist %d' % (a // 5)}
+                       for a in range((size + 9) // 10)]
+        self.artists = [{'name': 'Artist %d' % a} for a in range((size + 49) // 50)]
+        self.movies = [{'id': m + 1, 'title': 'Movie %d - Part %d' % (m, m % 3 + 1),
+                        'additional': {'file': [{'id': 1000 + m}]}}
+                       for m in range(max(size // 10, 1))]
+        self.tvshows = [{'id': s + 1, 'title': 'Show %d' % s} for s in range(max(size // 100, 1))]
+        self.episodes = [{'id': show['id'] * 100 + e, 'tvshow_id': show['id'], 'title': show['title'],
+                          'tagline': 'Episode %d' % e, 'additional': {'file': [{'id': 5000 + show['id'] * 100 + e}]}}
+                         for show in self.tvshows for e in range(10)]
+
+    def album_songs(self, name):
+        return [s['id'] for s in self.songs if s['additional']['song_tag']['album'] == name]
+
+
+class FakeSynology:
+    """
+    Stand-in for the parts of a DiskStation (DSM web API, AudioStation and
+    VideoStation) the controller uses, served on localhost.
+
+    Every answer is delayed by `latency` seconds.  With `error_every` set,
+    every n-th authenticated request fails with `error_code`; 106 and 107
+    also end the session, like a timed out or replaced login.  `stats()`
+    counts the requests and the bytes in both directions.
+    """
+
+    def __init__(self, port=0, latency=0.0, library_size=1000, error_every=0, error_code=106,
+                 cover_size=20000, api_index='synology-api-index.json'):
+        self.latency = latency
+        self.library = Library(library_size)
+        self.error_every = error_every
+        self.error_code = error_code
+        self.cover = os.urandom(cover_size)
+        self.cover_etag = '"%s"' % hashlib.sha1(self.cover).hexdigest()
+        with open(api_index) as index_file:
+            self.apis = {name: {'path': path, 'minVersion': min_version, 'maxVersion': max_version,
+                                'requestFormat': request_format}
+                         for (name, (path, min_version, max_version, request_format))
+                         in json.load(index_file).items()}
+
+        self.sessions = set()
+        self.issued = 0
+        self.playlist = []
+        self.state = {'audio': 'stopped', 'video': 'stopped'}
+        self.current = {'audio': None, 'video': None}
+        self._authenticated = 0
+        self._stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0}
+        self._lock = threading.Lock()
+
+        handler = type('Handler', (_Handler,), {'fake': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/webapi' % self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fakesynology', daemon=True).start()
+        logger.info('fake Synology on %s', self.url)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def expire_sessions(self):
+        with self._lock:
+            self.sessions.clear()
+
+    def _count(self, bytes_in, bytes_out):
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['bytes_in'] += bytes_in
+            self._stats['bytes_out'] += bytes_out
+
+    def handle(self, path, q):
+        """Answers a request, returns (status, content type, body, headers)."""
+        api = q.get('api')
+        if path.endswith('/query.cgi'):
+            return self._json({'success': True, 'data': self.apis})
+        if path.endswith('/auth.cgi'):
+            with self._lock:
+                self.issued += 1
+                sid = 'sid%d' % self.issued
+                self.sessions.add(sid)
+            return self._json({'success': True, 'data': {'sid': sid}})
+
+        with self._lock:
+            if q.get('_sid') not in self.sessions:
+                return self._error(106 if q.get('_sid') else 119)
+            self._authenticated += 1
+            if self.error_every and self._authenticated % self.error_every == 0:
+                if self.error_code in SESSION_ERRORS:
+                    self.sessions.discard(q.get('_sid'))
+                return self._error(self.error_code)
+
+        if api in ('SYNO.AudioStation.Cover', 'SYNO.VideoStation2.Poster'):
+            if q.get('If-None-Match') == self.cover_etag:
+                return (304, None, b'', {'ETag': self.cover_etag})
+            return (200, 'image/jpeg', self.cover, {'ETag': self.cover_etag})
+
+        method = getattr(self, '_' + (api or '').replace('.', '_'), None)
+        if not method:
+            return self._error(102)
+        try:
+            data = method(q)
+        except (KeyError, ValueError, IndexError):
+            return self._error(101)
+        if data is None:
+            return self._error(103)
+        return self._json({'success': True, 'data': data})
+
+    def _json(self, rsp):
+        return (200, 'application/json', json.dumps(rsp).encode('utf-8'), {})
+
+    def _error(self, code):
+        return self._json({'success': False, 'error': {'code': code}})
+
+    def _SYNO_AudioStation_RemotePlayer(self, q):
+        method = q['method']
+        if method == 'list':
+            return {'players': [AUDIO_PLAYER]}
+        if q.get('id', '').replace('upnp:', '') != AUDIO_PLAYER['id'].replace('upnp:', ''):
+            raise KeyError(q.get('id'))
+        if method == 'getplaylist':
+            (offset, limit) = (int(q.get('offset', 0)), int(q.get('limit', 0)))
+            songs = {s['id']: s for s in self.library.songs}
+            entries = [songs[i] if q.get('additional') else {'id': i, 'title': songs[i]['title']}
+                       for i in self.playlist[offset:offset + limit]]
+            return {'total': len(self.playlist), 'current': 0, 'songs': entries}
+        if method == 'updateplaylist':
+            added = [s for s in q.get('songs', '').split(',') if s]
+            for container in json.loads(q.get('containers_json') or '[]'):
+                added += self.library.album_songs(container.get('album'))
+            (offset, limit) = (int(q['offset']), int(q['limit']))
+            with self._lock:
+                if offset < 0:
+                    self.playlist += added
+                else:
+                    self.playlist[offset:offset + limit] = added
+                if q.get('play') == 'true':
+                    self.state['audio'] = 'playing'
+                    self.current['audio'] = self.playlist[0] if self.playlist else None
+            return {}
+        if method == 'control':
+            self.state['audio'] = STATES.get(q['action'], self.state['audio'])
+            return {}
+
+    def _SYNO_AudioStation_RemotePlayerStatus(self, q):
+        if q['method'] == 'getstatus':
+            songs = [s for s in self.library.songs if s['id'] == self.current['audio']]
+            return {'state': self.state['audio'], 'song': songs[0] if songs else None,
+                    'playlist_total': len(self.playlist)}
+
+    def _SYNO_VideoStation2_Controller_Device(self, q):
+        if q['method'] == 'list':
+            return {'device': [VIDEO_DEVICE]}
+
+    def _SYNO_VideoStation2_Controller_Playback(self, q):
+        if q['method'] == 'status':
+            return {'state': self.state['video']}
+        if q['method'] in ('play', 'pause', 'stop', 'next', 'prev'):
+            self.state['video'] = STATES.get(q['method'], self.state['video'])
+            return {}
+
+    def _SYNO_AudioStation_Song(self, q):
+        if q['method'] == 'getinfo':
+            return {'songs': [s for s in self.library.songs if s['id'] == q['id']][:1] or None}
+        if q['method'] == 'list':
+            return _page(q, 'songs', self.library.songs)
+
+    def _SYNO_AudioStation_Album(self, q):
+        albums = self.library.albums
+        if q.get('album'):
+            albums = [a for a in albums if a['name'].lower() == q['album'].lower()]
+        if q.get('album_artist'):
+            albums = [a for a in albums if a['album_artist'].lower() == q['album_artist'].lower()]
+        return _page(q, 'albums', albums)
+
+    def _SYNO_AudioStation_Artist(self, q):
+        artists = self.library.artists
+        if q.get('artist'):
+            artists = [a for a in artists if a['name'].lower() == q['artist'].lower()]
+        return _page(q, 'artists', artists)
+
+    def _SYNO_VideoStation2_Movie(self, q):
+        if q['method'] == 'getinfo':
+            ids = json.loads(q['id'])
+            return {'movie': [m for m in self.library.movies if m['id'] in ids]}
+        if q['method'] == 'list':
+            return _page(q, 'movie', self.library.movies)
+
+    def _SYNO_VideoStation2_TVShow(self, q):
+        if q['method'] == 'list':
+            return _page(q, 'tvshow', self.library.tvshows)
+
+    def _SYNO_VideoStation2_TVShowEpisode(self, q):
+        episodes = [e for e in self.library.episodes if str(e['tvshow_id']) == str(q.get('tvshow_id'))]
+        if q['method'] == 'getinfo':
+            ids = [int(i) for i in json.loads(q['id'])]
+            return {'episode': [e for e in episodes if e['id'] in ids]}
+        if q['method'] == 'list':
+            return _page(q, 'episode', episodes)
+
+
+def _page(q, key, entries):
+    (offset, limit) = (int(q.get('offset', 0)), int(q.get('limit', 0)))
+    return {key: entries[offset:offset + limit], 'total': len(entries), 'offset': offset}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        q = dict(parse_qsl(url.query))
+        if self.headers.get('If-None-Match'):
+            q['If-None-Match'] = self.headers['If-None-Match']
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+
+        (status, content_type, body, headers) = self.fake.handle(url.path, q)
+        # counted before answering, the client may look at the stats right after
+        self.fake._count(len(self.requestline) + len(str(self.headers)), len(body))
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def _actions(controller, fake):
+    """(name, action) pairs, for the qrplay actions and the qrgen lookups."""
+    from controller import TypeMode
+
+    album = fake.library.albums[-1]
+    movie = fake.library.movies[-1]
+    episode = fake.library.episodes[-1]
+    lookups = ['dsaudio:song=%s' % s['id'] for s in fake.library.songs[:20]]
+
+    def play_video():
+        controller.switch_mode(TypeMode.VIDEO)
+        controller.play_video(None, {'api': 'SYNO.VideoStation2.Controller.Playback', 'method': 'play',
+                                     'file_id': movie['additional']['file'][0]['id'],
+                                     'playback_target': 'file_id', 'version': 2})
+
+    def play_audio(data):
+        def action():
+            controller.switch_mode(TypeMode.AUDIO)
+            controller.play_audio(data)
+        return action
+
+    return [
+        ('play album', play_audio('[{"type":"album","album":"%s","album_artist":"%s"}]'
+                                  % (album['name'], album['album_artist']))),
+        ('play song', play_audio(fake.library.songs[0]['id'])),
+        ('cmd:pause', lambda: controller.handle_command('cmd:pause')),
+        ('cmd:play', lambda: controller.handle_command('cmd:play')),
+        ('cmd:next', lambda: controller.handle_command('cmd:next')),
+        ('cmd:clear', lambda: controller.handle_command('cmd:clear')),
+        ('play video', play_video),
+        ('cmd:stop', lambda: controller.handle_command('cmd:stop')),
+        ('get_song', lambda: controller.get_song(fake.library.songs[-1]['id'])),
+        ('get_album', lambda: controller.get_album(album['name'].upper(), album['album_artist'])),
+        ('get_artist', lambda: controller.get_artist(fake.library.artists[-1]['name'].lower())),
+        ('get_movie', lambda: controller.get_movie(str(movie['id']))),
+        ('get_episode', lambda: controller.get_episode(str(episode['id']), str(episode['tvshow_id']))),
+        ('%d lookups' % len(lookups), lambda: controller.get_library_tracks(lookups)),
+        ('library sync', lambda: controller.sync_library()),
+        ('%d lookups (index)' % len(lookups), lambda: controller.get_library_tracks(lookups)),
+    ]
+
+
+def benchmark(latency=0.02, library_size=1000, error_every=0, error_code=106, repeat=3):
+    """Runs the controller actions against a fake server, returns {action: stats}."""
+    from diskstationcontroller import DiskstationController
+    from libraryindex import LibraryIndex
+
+    fake = FakeSynology(latency=latency, library_size=library_size, error_every=error_every,
+                        error_code=error_code).start()
+    workdir = tempfile.mkdtemp(prefix='qrocodile-bench-')
+    results = {}
+    try:
+        def measure(name, action):
+            before = fake.stats()
+            started = time.perf_counter()
+            failed = 0
+            try:
+                action()
+            except Exception as e:
+                logger.warning('%s failed: %s', name, e)
+                failed = 1
+            elapsed = time.perf_counter() - started
+            after = fake.stats()
+            stats = {k: after[k] - before[k] for k in after}
+            stats['seconds'] = elapsed
+            stats['failed'] = failed
+            results.setdefault(name, []).append(stats)
+
+        def create():
+            controller = DiskstationController(
+                fake.url, 'user', 'secret', 'TV', 'QRocodile',
+                session_file=os.path.join(workdir, 'sessions.json'),
+                players_file=os.path.join(workdir, 'players.json'),
+                library=LibraryIndex(os.path.join(workdir, 'library.db')),
+                # polling the players would add requests to every action
+                status_interval=0)
+            # the players are discovered in the background
+            controller.wait_players()
+            return controller
+
+        for run in range(repeat):
+            for name in ('players.json', 'sessions.json', 'library.db'):
+                if os.path.exists(os.path.join(workdir, name)):
+                    os.remove(os.path.join(workdir, name))
+            controller = None
+
+            def init():
+                nonlocal controller
+                controller = create()
+            measure('init (no cache)', init)
+            measure('init (cached)', create)
+            for (name, action) in _actions(controller, fake):
+                measure(name, action)
+    finally:
+        fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print('%-22s %8s %10s %10s %7s' % ('action', 'requests', 'ms', 'kB', 'failed'))
+    summary = {}
+    for (name, runs) in results.items():
+        summary[name] = {k: sum(r[k] for r in runs) / len(runs) for k in runs[0]}
+        print('%-22s %8.1f %10.1f %10.1f %6.0f%%' % (
+            name, summary[name]['requests'], summary[name]['seconds'] * 1000,
+            (summary[name]['bytes_in'] + summary[name]['bytes_out']) / 1024,
+            summary[name]['failed'] * 100))
+    return summary
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Serves a fake DiskStation, or benchmarks the Diskstation controller against one.')
+    arg_parser.add_argument('--benchmark', action='store_true',
+                            help='run the controller actions against the fake and print their cost')
+    arg_parser.add_argument('--port', type=int, default=5000, help='port to serve on')
+    arg_parser.add_argument('--latency', type=float, default=0.02,
+                            help='seconds every answer is delayed')
+    arg_parser.add_argument('--library-size', type=int, default=1000,
+                            help='number of songs (albums, artists, movies and shows are derived)')
+    arg_parser.add_argument('--error-every', type=int, default=0,
+                            help='fail every n-th authenticated request (0 never)')
+    arg_parser.add_argument('--error-code', type=int, default=106, choices=(105, 106, 107),
+                            help='error code of the failing requests')
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='benchmark runs to average')
+    args = arg_parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.latency, args.library_size, args.error_every, args.error_code, args.repeat)
+    else:
+        fake = FakeSynology(args.port, args.latency, args.library_size, args.error_every,
+                            args.error_code).start()
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            fake.stop()
@@ -0,0 +1,171 @@
+import logging
+import queue
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from scanner import DecodeWorker, Frame
+
+# create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to info
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(lineno)s:%(funcName)s - %(message)s'))
+logger.addHandler(ch)
+
+# A recording is a header (magic, height, width, channels) followed by fixed size
+# records of a float64 capture timestamp and the raw frame, so it can be memory mapped.
+MAGIC = b'QROCFRM1'
+HEADER = struct.Struct('<8sIII12x')
+
+
+def _record_dtype(shape):
+    return np.dtype([('timestamp', '<f8'), ('image', np.uint8, shape)])
+
+
+class FrameRecorder:
+    """
+    Appends raw camera frames to a recording file.
+
+    The frames are written by a thread of their own, so a slow disk (e.g. the
+    SD card of a Pi) does not slow down capturing, which would make the
+    recorded timestamps useless for replays.  Frames arriving while
+    `max_pending` frames still wait to be written are dropped and counted.
+    """
+
+    def __init__(self, path, max_pending=30):
+        self.path = path
+        self.shape = None
+        self.count = 0
+        self.dropped = 0
+        self._file = None
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='recorder', daemon=True)
+        self._thread.start()
+
+    def write(self, image, timestamp):
+        if self.shape is None:
+            self.shape = image.shape
+        elif image.shape != self.shape:
+            raise ValueError('frame size changed from %s to %s' % (self.shape, image.shape))
+
+        # the camera hands out a new array per frame, so it is not copied
+        try:
+            self._pending.put_nowait((image, timestamp))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self._pending.put(None)
+        self._thread.join()
+        if self._file:
+            self._file.close()
+            logger.info('recorded %d frames of %s to %s (%d dropped, the disk was too slow)',
+                        self.count, self.shape, self.path, self.dropped)
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            (image, timestamp) = item
+            if self._file is None:
+                channels = image.shape[2] if image.ndim == 3 else 1
+                self._file = open(self.path, 'wb')
+                self._file.write(HEADER.pack(MAGIC, image.shape[0], image.shape[1], channels))
+            self._file.write(struct.pack('<d', timestamp))
+            self._file.write(np.ascontiguousarray(image).data)
+            self.count += 1
+
+
+class FrameReader:
+    """Memory maps a recording written by FrameRecorder."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            (magic, height, width, channels) = HEADER.unpack(f.read(HEADER.size))
+            f.seek(0, 2)
+            size = f.tell()
+        if magic != MAGIC:
+            raise ValueError('%s is not a frame recording' % path)
+
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        dtype = _record_dtype(shape)
+        # ignore a partially written last record
+        count = (size - HEADER.size) // dtype.itemsize
+        self.records = np.memmap(path, dtype, 'r', offset=HEADER.size, shape=(count,))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        record = self.records[index]
+        return (float(record['timestamp']), record['image'])
+
+
+def replay(path, decode, handle, width=400, tracker=None, gate=None, debouncer=None):
+    """
+    Feeds a recording through the decode and dispatch path of the scanner as
+    fast as possible and reports frames/sec, decode hit rate and the time to
+    the first decode of each card.
+
+    The time to first decode is measured in recording time, from the first
+    decoded frame after the scene was still (or after the previous card) to
+    the first frame the card was decoded in, so it is most meaningful with
+    the motion gate enabled.
+    """
+    frames = FrameReader(path)
+    scans = queue.Queue()
+    worker = DecodeWorker(None, scans, decode, width, tracker=tracker, gate=gate,
+                          debouncer=debouncer)
+
+    decoded = hits = 0
+    episode_start = None
+    first_decode = OrderedDict()
+    started = time.perf_counter()
+
+    for index in range(len(frames)):
+        (timestamp, image) = frames[index]
+        barcodes = worker.process(Frame(index + 1, timestamp, image))
+
+        if barcodes is None:
+            # skipped by the motion gate, nothing changed
+            episode_start = None
+        else:
+            decoded += 1
+            if episode_start is None:
+                episode_start = timestamp
+            if barcodes:
+                hits += 1
+                for barcode in barcodes:
+                    code = barcode.data.decode('utf-8')
+                    if code not in first_decode:
+                        first_decode[code] = timestamp - episode_start
+                episode_start = None
+
+        while not scans.empty():
+            handle(scans.get_nowait())
+
+    elapsed = time.perf_counter() - started
+    stats = {
+        'frames': len(frames),
+        'decoded': decoded,
+        'hits': hits,
+        'seconds': elapsed,
+        'fps': len(frames) / elapsed if elapsed else 0,
+        'hit_rate': hits / decoded if decoded else 0,
+        'time_to_first_decode': first_decode
+    }
+
+    logger.info('%d frames in %.2fs: %.1f frames/sec, %d decoded, hit rate %.1f%%',
+                stats['frames'], elapsed, stats['fps'], decoded, stats['hit_rate'] * 100)
+    for (code, ttfd) in first_decode.items():
+        logger.info('  %6.0fms to first decode of %s', ttfd * 1000, code)
+    return stats
@@ -0,0 +1,83 @@
+import logging
+import queue
+import threading
+import time
+
+# create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to info
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(lineno)s:%(funcName)s - %(message)s'))
+logger.addHandler(ch)
+
+
+# on, off, on, off with 0.15s each
+DOUBLE_BLINK = [(1, 0.15), (0, 0.15), (1, 0.15), (0, 0)]
+
+
+class NullLed:
+    """LED driver for hosts without a (writable) LED."""
+
+    def blink(self, pattern=DOUBLE_BLINK):
+        logger.debug('LED BLINK!!!')
+
+    def close(self):
+        pass
+
+
+class SysfsLed:
+    """
+    Drives an LED through its sysfs files, e.g. the onboard green LED of a
+    Raspberry Pi 3 Model B at /sys/class/leds/led0.
+
+    The files are opened once and blink patterns are played by a background
+    thread, so blink() returns immediately.
+    """
+
+    def __init__(self, path='/sys/class/leds/led0'):
+        with open(path + '/trigger') as trigger:
+            # e.g. 'none [mmc0] timer', the active trigger is in brackets
+            active = [t for t in trigger.read().split() if t.startswith('[')]
+        self._trigger = active[0].strip('[]') if active else 'none'
+
+        self._trigger_file = open(path + '/trigger', 'w', buffering=1)
+        self._brightness = open(path + '/brightness', 'w', buffering=1)
+        # keep the LED from being driven by its trigger while we use it
+        self._trigger_file.write('none\n')
+
+        self._patterns = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='led', daemon=True)
+        self._thread.start()
+
+    def blink(self, pattern=DOUBLE_BLINK):
+        """Plays a list of (brightness, seconds) steps."""
+        self._patterns.put(pattern)
+
+    def close(self):
+        self._patterns.put(None)
+        self._thread.join(2.0)
+        self._trigger_file.write(self._trigger + '\n')
+        self._trigger_file.close()
+        self._brightness.close()
+
+    def _run(self):
+        while True:
+            pattern = self._patterns.get()
+            if pattern is None:
+                return
+            for (brightness, duration) in pattern:
+                self._brightness.write('%d\n' % brightness)
+                time.sleep(duration)
+
+
+def open_led(path='/sys/class/leds/led0'):
+    try:
+        return SysfsLed(path)
+    except OSError as e:
+        # writing the sysfs files needs root (or a udev rule)
+        logger.warning('cannot drive LED at %s, not blinking: %s', path, e)
+        return NullLed()
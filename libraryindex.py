@@ -0,0 +1,226 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from controller import TypeMode
+
+# create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to info
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(lineno)s:%(funcName)s - %(message)s'))
+logger.addHandler(ch)
+
+
+# entries asked for per list request
+PAGE_SIZE = 1000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS songs (
+    id TEXT PRIMARY KEY, title TEXT, album TEXT, artist TEXT, album_artist TEXT,
+    generation INTEGER);
+CREATE TABLE IF NOT EXISTS albums (
+    name TEXT, name_key TEXT, album_artist TEXT, album_artist_key TEXT, artist TEXT,
+    display_artist TEXT, generation INTEGER, PRIMARY KEY (name_key, album_artist_key));
+CREATE TABLE IF NOT EXISTS artists (
+    name TEXT, name_key TEXT PRIMARY KEY, generation INTEGER);
+CREATE TABLE IF NOT EXISTS movies (
+    id TEXT PRIMARY KEY, title TEXT, file_id INTEGER, generation INTEGER);
+CREATE TABLE IF NOT EXISTS episodes (
+    id TEXT PRIMARY KEY, tvshow_id TEXT, title TEXT, tagline TEXT, file_id INTEGER,
+    generation INTEGER);
+CREATE TABLE IF NOT EXISTS sync (
+    kind TEXT PRIMARY KEY, generation INTEGER, next_offset INTEGER, synced REAL);
+CREATE INDEX IF NOT EXISTS albums_name ON albums (name_key);
+CREATE INDEX IF NOT EXISTS episodes_tvshow ON episodes (tvshow_id);
+'''
+
+
+def _key(name):
+    return (name or '').casefold()
+
+
+def _file_id(item):
+    files = item.get('additional', {}).get('file') or [{}]
+    return files[0].get('id')
+
+
+def _song_row(song):
+    tag = song.get('additional', {}).get('song_tag', {})
+    return (str(song['id']), song['title'], tag.get('album'), tag.get('artist'),
+            tag.get('album_artist'))
+
+
+def _album_row(album):
+    return (album['name'], _key(album['name']), album['album_artist'],
+            _key(album['album_artist']), album.get('artist'), album.get('display_artist'))
+
+
+def _artist_row(artist):
+    return (artist['name'], _key(artist['name']))
+
+
+def _movie_row(movie):
+    return (str(movie['id']), movie['title'], _file_id(movie))
+
+
+def _episode_row(episode):
+    return (str(episode['id']), str(episode['tvshow_id']), episode.get('title'),
+            episode.get('tagline'), _file_id(episode))
+
+
+# kind -> (path, list payload, key of the entries in the answer, mode, to row, insert)
+KINDS = {
+    'songs': ('AudioStation/song.cgi',
+              {'api': 'SYNO.AudioStation.Song', 'version': 3, 'method': 'list',
+               'library': 'shared', 'additional': 'song_tag'},
+              'songs', TypeMode.AUDIO, _song_row,
+              'INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?)'),
+    'albums': ('AudioStation/album.cgi',
+               {'api': 'SYNO.AudioStation.Album', 'version': 3, 'method': 'list',
+                'library': 'shared'},
+               'albums', TypeMode.AUDIO, _album_row,
+               'INSERT OR REPLACE INTO albums VALUES (?, ?, ?, ?, ?, ?, ?)'),
+    'artists': ('AudioStation/artist.cgi',
+                {'api': 'SYNO.AudioStation.Artist', 'version': 4, 'method': 'list',
+                 'library': 'shared'},
+                'artists', TypeMode.AUDIO, _artist_row,
+                'INSERT OR REPLACE INTO artists VALUES (?, ?, ?)'),
+    'movies': ('entry.cgi',
+               {'api': 'SYNO.VideoStation2.Movie', 'version': 1, 'method': 'list',
+                'library_id': 0, 'additional': '["file"]'},
+               'movie', TypeMode.VIDEO, _movie_row,
+               'INSERT OR REPLACE INTO movies VALUES (?, ?, ?, ?)'),
+    # listed per TV show, see LibraryIndex._episodes()
+    'episodes': ('entry.cgi',
+                 {'api': 'SYNO.VideoStation2.TVShow', 'version': 1, 'method': 'list',
+                  'library_id': 0},
+                 'tvshow', TypeMode.VIDEO, _episode_row,
+                 'INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?, ?)')
+}
+
+
+def _pages(request, path, payload, key, mode, offset=0):
+    """Yields the entries of a Synology list API page by page, starting at offset."""
+    while True:
+        data = request(path, dict(payload, offset=offset, limit=PAGE_SIZE), mode)
+        entries = data.get(key) or []
+        yield entries
+        offset += len(entries)
+        if not entries or offset >= data.get('total', 0):
+            return
+
+
+class LibraryIndex:
+    """
+    Local copy of the AudioStation/VideoStation library metadata in SQLite.
+
+    Names are looked up case-insensitively through case-folded, indexed
+    columns.  sync() pages through the Synology list APIs and commits every
+    page, an interrupted sync continues where it stopped; entries not seen
+    during a complete pass are removed afterwards.
+    """
+
+    def __init__(self, path='.synology-library.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def song(self, id):
+        return self._one('SELECT * FROM songs WHERE id = ?', str(id))
+
+    def album(self, name, album_artist=None):
+        if album_artist is not None:
+            # another artist's album with the same name is not a match
+            return self._one('SELECT * FROM albums WHERE name_key = ? AND album_artist_key = ?',
+                             _key(name), _key(album_artist))
+        return self._one('SELECT * FROM albums WHERE name_key = ? ORDER BY name', _key(name))
+
+    def artist(self, name):
+        return self._one('SELECT * FROM artists WHERE name_key = ?', _key(name))
+
+    def movie(self, id):
+        return self._one('SELECT * FROM movies WHERE id = ?', str(id))
+
+    def episode(self, id):
+        return self._one('SELECT * FROM episodes WHERE id = ?', str(id))
+
+    def age(self, kind):
+        """Seconds since kind was completely synced, None if it never was."""
+        state = self._one('SELECT synced FROM sync WHERE kind = ?', kind)
+        if not state or not state['synced']:
+            return None
+        return time.time() - state['synced']
+
+    def sync(self, request, max_age=0, kinds=None):
+        """
+        Updates the kinds not synced within max_age seconds.
+
+        request(path, payload, mode) performs a Synology API request and
+        returns its data, e.g. DiskstationController.perform_request.
+        """
+        for kind in kinds or KINDS:
+            age = self.age(kind)
+            if age is not None and age < max_age:
+                logger.debug('%s synced %.0fs ago', kind, age)
+                continue
+            try:
+                self._sync(request, kind)
+            except Exception as e:
+                logger.error('could not sync %s: %s', kind, e)
+
+    def _sync(self, request, kind):
+        (path, payload, key, mode, to_row, insert) = KINDS[kind]
+        state = self._one('SELECT * FROM sync WHERE kind = ?', kind)
+        if state and state['next_offset']:
+            # continue the interrupted pass
+            (generation, offset) = (state['generation'], state['next_offset'])
+            logger.info('continuing %s sync at %d', kind, offset)
+        else:
+            (generation, offset) = ((state['generation'] if state else 0) + 1, 0)
+
+        started = time.monotonic()
+        count = 0
+        for entries in _pages(request, path, payload, key, mode, offset):
+            if kind == 'episodes':
+                # a page of TV shows, their episodes are listed per show
+                rows = [to_row(dict(episode, tvshow_id=show['id']))
+                        for show in entries for episode in self._episodes(request, show['id'])]
+            else:
+                rows = [to_row(entry) for entry in entries]
+            offset += len(entries)
+            count += len(rows)
+            with self._lock, self._db:
+                self._db.executemany(insert, [row + (generation,) for row in rows])
+                self._db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, ?, ?)',
+                                 (kind, generation, offset, state['synced'] if state else None))
+
+        with self._lock, self._db:
+            removed = self._db.execute('DELETE FROM %s WHERE generation < ?' % kind,
+                                       (generation,)).rowcount
+            self._db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, 0, ?)',
+                             (kind, generation, time.time()))
+        logger.info('synced %d %s (%d removed) in %.1fs', count, kind, removed,
+                    time.monotonic() - started)
+
+    def _episodes(self, request, tvshow_id):
+        payload = {'api': 'SYNO.VideoStation2.TVShowEpisode', 'version': 1, 'method': 'list',
+                   'library_id': 0, 'tvshow_id': tvshow_id, 'additional': '["file"]'}
+        for entries in _pages(request, 'entry.cgi', payload, 'episode', TypeMode.VIDEO):
+            yield from entries
+
+    def _one(self, query, *params):
+        with self._lock:
+            row = self._db.execute(query, params).fetchone()
+        return dict(row) if row else None
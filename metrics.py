@@ -0,0 +1,189 @@
+import json
+import logging
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to info
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(lineno)s:%(funcName)s - %(message)s'))
+logger.addHandler(ch)
+
+
+# upper bounds in seconds, from a fast decode to a slow NAS
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DESCRIPTIONS = {
+    'qrocodile_stage_seconds': 'Time spent per scanner stage',
+    'qrocodile_action_seconds': 'Time from capturing a card to its action being done',
+    'qrocodile_http_seconds': 'Duration of HTTP calls to the controller backends',
+    'qrocodile_frames_total': 'Frames seen by the decode stage'
+}
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Metrics:
+    """
+    Histograms and counters, identified by a metric name and labels.
+
+    The (thread safe) values can be rendered in the Prometheus text format or
+    as a dict for a JSON dump.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            for (name, items) in _by_name(self._histograms):
+                lines += _header(name, 'histogram')
+                for (labels, h) in items:
+                    cumulative = 0
+                    for (bound, count) in zip(h.buckets, h.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (name, _labels(labels, le=repr(bound)), cumulative))
+                    lines.append('%s_bucket%s %d' % (name, _labels(labels, le='+Inf'), h.count))
+                    lines.append('%s_sum%s %f' % (name, _labels(labels), h.sum))
+                    lines.append('%s_count%s %d' % (name, _labels(labels), h.count))
+            for (name, items) in _by_name(self._counters):
+                lines += _header(name, 'counter')
+                for (labels, value) in items:
+                    lines.append('%s%s %d' % (name, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        result = {}
+        with self._lock:
+            for ((name, labels), h) in self._histograms.items():
+                result.setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'count': h.count,
+                    'sum': h.sum,
+                    'mean': h.sum / h.count if h.count else 0,
+                    'buckets': dict(zip([str(b) for b in h.buckets], h.counts))
+                })
+            for ((name, labels), value) in self._counters.items():
+                result.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        return result
+
+
+def _by_name(values):
+    names = {}
+    for ((name, labels), value) in sorted(values.items()):
+        names.setdefault(name, []).append((labels, value))
+    return names.items()
+
+
+def _header(name, kind):
+    return ['# HELP %s %s' % (name, DESCRIPTIONS.get(name, name)), '# TYPE %s %s' % (name, kind)]
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for (k, v) in pairs)
+
+
+# the metrics of this process
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = metrics.prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(metrics.as_dict()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(port, host='127.0.0.1'):
+    """Serves /metrics (Prometheus) and /metrics.json from a background thread, None if it cannot."""
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        # e.g. the port is taken, the scanner does not need the metrics
+        logger.warning('cannot serve metrics on %s:%d, not serving them: %s', host, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('serving metrics on http://%s:%d/metrics', host, port)
+    return server
+
+
+def dump_on_signal(signum=signal.SIGUSR1):
+    """Logs all metrics as JSON when the process receives signum (e.g. kill -USR1 <pid>)."""
+    # the handler runs in the main thread, maybe in the middle of observe()
+    # holding the lock, so it only wakes up a thread doing the dump
+    requested = threading.Event()
+
+    def dump():
+        while True:
+            requested.wait()
+            requested.clear()
+            logger.info('metrics: %s', json.dumps(metrics.as_dict()))
+
+    threading.Thread(target=dump, name='metrics-dump', daemon=True).start()
+    signal.signal(signum, lambda signum, frame: requested.set())
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import cv2
+
+
+class Preview:
+    """
+    Shows the latest decoded frame and its codes in a window.
+
+    The decode stage hands frames to offer(), which only copies one when the
+    next preview is due and returns right away otherwise.  Drawing and
+    displaying happen in show(), on the calling (main) thread, at most `fps`
+    times a second, so the preview does not slow down scanning.
+    """
+
+    def __init__(self, title='Barcode Scanner', fps=10.0):
+        self.title = title
+        self.interval = 1.0 / fps
+        self._due = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._fresh = threading.Event()
+
+    def offer(self, image, barcodes):
+        now = time.monotonic()
+        if now < self._due:
+            return
+        self._due = now + self.interval
+
+        with self._lock:
+            self._snapshot = (image.copy(), list(barcodes))
+        self._fresh.set()
+
+    def show(self, timeout=0.5):
+        """Displays the newest snapshot, waiting up to timeout for one."""
+        if self._fresh.wait(timeout):
+            self._fresh.clear()
+            with self._lock:
+                (image, barcodes) = self._snapshot
+            cv2.imshow(self.title, self._draw(image, barcodes))
+        # keep the window responsive
+        cv2.waitKey(1)
+
+    def close(self):
+        cv2.destroyAllWindows()
+
+    def _draw(self, image, barcodes):
+        frame = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        for barcode in barcodes:
+            # extract the bounding box location of the barcode and draw
+            # the bounding box surrounding the barcode on the image
+            (x, y, w, h) = barcode.rect
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 2)
+
+            # draw the barcode data and barcode type on the image
+            text = "{} ({})".format(barcode.data.decode("utf-8"), barcode.type)
+            cv2.putText(frame, text, (x, y - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
+        return frame
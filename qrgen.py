@@ -33,9 +33,11 @@ import sys
 import urllib
 from urllib.request import urlopen, Request, build_opener
 from urllib.parse import quote, urlencode
-from controller import GenerateController, strip_title_junk
+from controller import GenerateController, strip_title_junk, configure_transport
 from sonoscontroller import SonosController
 from diskstationcontroller import DiskstationController
+from libraryindex import LibraryIndex
+from artcache import ArtworkCache
 
 from configparser import ConfigParser
 import gettext
@@ -81,13 +83,24 @@ arg_parser.add_argument(
 args = arg_parser.parse_args()
 
 
+# One pool of kept-alive connections for all controllers
+configure_transport(pool_size=parser.getint('http', 'pool_size', fallback=4),
+                    connect_timeout=parser.getfloat('http', 'connect_timeout', fallback=3.05),
+                    read_timeout=parser.getfloat('http', 'read_timeout', fallback=10.0))
+
 sonos=SonosController(parser.get('sonos', 'url') if parser.has_option('sonos', 'url') else "http:localhost")
 ds=DiskstationController(
     parser.get('diskstation', 'url') if parser.has_option('diskstation', 'url') else "http://diskstation:5000/webapi",
     parser.get('diskstation', 'user'),
-    parser.get('diskstation', 'password')
+    parser.get('diskstation', 'password'),
+    library=LibraryIndex(parser.get('diskstation', 'library_file', fallback='.synology-library.db')),
+    status_interval=0
     )
 
+# Artwork is kept between runs, see `[artwork]` in the README
+artwork=ArtworkCache(parser.get('artwork', 'directory', fallback='.artwork-cache'),
+                     parser.getint('artwork', 'max_age', fallback=86400))
+
 # TODO move to spotify controller
 if args.spotify_username:
     # Set up Spotify access (comment this out if you don't want to generate cards for Spotify tracks)
@@ -112,8 +125,8 @@ def process_command(uri, index):
     # Create a QR code from the command URI
     print(subprocess.check_output(['qrencode', '-o', qrout, uri]))
 
-    # Fetch the artwork and save to the output directory
-    print(subprocess.check_output(['curl', arturl, '-o', artout]))
+    # Fetch the artwork (unless cached) and save to the output directory
+    artwork.fetch(arturl, artout)
 
     return (cmdname, None, None)
 
@@ -143,15 +156,16 @@ def process_spotify_track(uri, index):
     # Create a QR code from the track URI
     print(subprocess.check_output(['qrencode', '-o', qrout, uri]))
 
-    # Fetch the artwork and save to the output directory
-    print(subprocess.check_output(['curl', arturl, '-o', artout]))
+    # Fetch the artwork (unless cached) and save to the output directory
+    artwork.fetch(arturl, artout)
 
     return (song.encode('utf-8'), album.encode('utf-8'), artist.encode('utf-8'))
 
 
-def process_library_track(controller, uri, index):
+def process_library_track(controller, uri, index, track=None):
 
-    track=controller.get_library_track(uri)
+    if track is None:
+        track=controller.get_library_track(uri)
 
     artist=track['artist'] if 'artist' in track else ''
     song=track['song'] if 'song' in track else ''
@@ -167,8 +181,8 @@ def process_library_track(controller, uri, index):
     print(subprocess.check_output(['qrencode', '-o', qrout, data.encode('iso-8859-1')]))
 
 
-    # Fetch the artwork and save to the output directory
-    print(subprocess.check_output(['curl', arturl, '-o', artout]))
+    # Fetch the artwork (unless cached) and save to the output directory
+    artwork.fetch(arturl, artout, track.get('artkey'))
 
     print('done: ' + data)
 
@@ -261,15 +275,17 @@ def generate_cards():
 <body>
 '''
 
-    for line in lines:
-        # Trim newline
-        line=line.strip()
+    # Trim newlines, remove any trailing comments (and ignore any empty or comment-only lines)
+    lines=[line.split('#')[0].strip() for line in lines]
+    lines=[line for line in lines if line]
 
-        # Remove any trailing comments and newline (and ignore any empty or comment-only lines)
-        line=line.split('#')[0]
-        line=line.strip()
-        if not line:
-            continue
+    # Look up all Diskstation items at once instead of one after another
+    dsuris=[line for line in lines if line.startswith('dsvideo:') or line.startswith('dsaudio:')]
+    if dsuris:
+        ds.sync_library(parser.getint('diskstation', 'library_ttl', fallback=86400))
+    dstracks=dict(zip(dsuris, ds.get_library_tracks(dsuris)))
+
+    for line in lines:
 
         mode = line.split(':')[0]
 
@@ -280,7 +296,7 @@ def generate_cards():
         elif line.startswith('lib:'):
             (song, album, artist)=process_library_track(sonos, line, index)
         elif line.startswith('dsvideo:') or line.startswith('dsaudio:'):
-            (song, album, artist)=process_library_track(ds, line, index)
+            (song, album, artist)=process_library_track(ds, line, index, dstracks[line])
         else:
             print('Failed to handle URI: ' + line)
             exit(1)
@@ -23,17 +23,20 @@
 
 import argparse
 import json
-import os
 import subprocess
 import sys
-from time import sleep
-import cv2
-from pyzbar import pyzbar
-import imutils
+from time import sleep, monotonic
 from imutils.video import VideoStream
+from decoders import create_decoder
+from dispatch import DispatchExecutor
+from framerecorder import FrameRecorder, replay
+from preview import Preview
+from led import open_led, NullLed
+from metrics import metrics, serve, dump_on_signal
+from scanner import ScanPipeline, DecodeProcesses, RegionTracker, MotionGate, RateScheduler, Debouncer
 from sonoscontroller import SonosController
 from diskstationcontroller import DiskstationController
-from controller import TypeMode
+from controller import TypeMode, DummyController, configure_transport
 
 from configparser import ConfigParser
 
@@ -60,17 +63,41 @@ arg_parser.add_argument(
     '--debug-file', help='read commands from a file instead of launching scanner')
 arg_parser.add_argument(
     '--show-frame', action='store_true', help='display videoframe with recognized code')
+arg_parser.add_argument(
+    '--record-file', help='record the raw camera frames to a file while scanning')
+arg_parser.add_argument(
+    '--replay-file', help='benchmark the scanner on recorded frames against a dummy controller')
 args = arg_parser.parse_args()
 
+decoder = create_decoder(parser.get('scanner', 'decoder', fallback='pyzbar'))
+# forked before the controller, the metrics server and the camera start their threads
+decode_pool = None
+if not args.debug_file and not args.replay_file \
+        and parser.getint('scanner', 'decode_processes', fallback=0) > 0:
+    decode_pool = DecodeProcesses(decoder, parser.getint('scanner', 'decode_processes')).start()
+
+# One pool of kept-alive connections for all controllers
+configure_transport(pool_size=parser.getint('http', 'pool_size', fallback=4),
+                    connect_timeout=parser.getfloat('http', 'connect_timeout', fallback=3.05),
+                    read_timeout=parser.getfloat('http', 'read_timeout', fallback=10.0))
+
 # sonos=SonosController(parser.get('sonos', 'url') if parser.has_option('sonos', 'url') else "http:localhost")
-controller = DiskstationController(
-    parser.get('diskstation', 'url') if parser.has_option(
-        'diskstation', 'url') else "http://diskstation:5000/webapi",
-    parser.get('diskstation', 'user'),
-    parser.get('diskstation', 'password'),
-    '[TV]Samsung LED40',
-    'QRocodile'
-)
+if args.replay_file:
+    controller = DummyController()
+else:
+    controller = DiskstationController(
+        parser.get('diskstation', 'url') if parser.has_option(
+            'diskstation', 'url') else "http://diskstation:5000/webapi",
+        parser.get('diskstation', 'user'),
+        parser.get('diskstation', 'password'),
+        '[TV]Samsung LED40',
+        'QRocodile',
+        session_ttl=parser.getint('diskstation', 'session_ttl', fallback=900),
+        players_ttl=parser.getint('diskstation', 'players_ttl', fallback=3600),
+        api_ttl=parser.getint('diskstation', 'api_ttl', fallback=0),
+        playlist_ttl=parser.getint('diskstation', 'playlist_ttl', fallback=300),
+        status_interval=parser.getfloat('diskstation', 'status_interval', fallback=5.0)
+    )
 
 isPI = parser.getboolean('DEFAULT', 'isPI', fallback=True)
 # Load the most recently used device, if available, otherwise fall back on the `default-device` argument
@@ -84,9 +111,6 @@ except:
 
 controller.switch_room(current_device)
 
-# Keep track of the last-seen code
-last_qrcode = ''
-
 
 class Mode:
     PLAY_SONG_IMMEDIATELY = 1
@@ -109,31 +133,17 @@ def speak(phrase):
     controller.say(phrase)
 
 
-# Causes the onboard green LED to blink on and off twice.  (This assumes Raspberry Pi 3 Model B; your
-# mileage may vary.)
+# The onboard green LED (this assumes Raspberry Pi 3 Model B; your mileage may vary.)
+led = open_led(parser.get('DEFAULT', 'led', fallback='/sys/class/leds/led0')) if isPI else NullLed()
+
+
+# Causes the onboard green LED to blink on and off twice, without blocking the caller.
 def blink_led():
     if not isPI:
         print(_('not in PI mode, LED BLINK!!!'))
         return
 
-    duration = 0.15
-
-    def led_off():
-        os.system("echo 0 | sudo tee /sys/class/leds/led0/brightness > /dev/null")
-
-    def led_on():
-        os.system("echo 1 | sudo tee /sys/class/leds/led0/brightness > /dev/null")
-
-    # Technically we only need to do this once when the script launches
-    os.system("echo none | sudo tee /sys/class/leds/led0/trigger > /dev/null")
-
-    led_on()
-    sleep(duration)
-    led_off()
-    sleep(duration)
-    led_on()
-    sleep(duration)
-    led_off()
+    led.blink()
 
 
 def handle_command(qrcode):
@@ -175,9 +185,12 @@ def handle_library_item(uri):
         elif dsMode == 'dsaudio':
             controller.switch_mode(TypeMode.AUDIO)
 
-            print(_('PLAYING DS AUDIO: ') + dsData + ' (' + dsMode + ')')
-
-            controller.play_audio(dsData)
+            if current_mode == Mode.BUILD_QUEUE:
+                print(_('QUEUEING DS AUDIO: ') + dsData + ' (' + dsMode + ')')
+                controller.load_audio(dsData)
+            else:
+                print(_('PLAYING DS AUDIO: ') + dsData + ' (' + dsMode + ')')
+                controller.play_audio(dsData)
         else:
             print(_('UNKNOWN DS ITEM : ') + dsData + ' (' + dsMode + ')')
 
@@ -208,14 +221,6 @@ def handle_spotify_item(uri):
 
 
 def handle_qrcode(qrcode):
-    global last_qrcode
-
-    # Ignore redundant codes, except for commands like "whatsong", where you might
-    # want to perform it multiple times
-    if qrcode == last_qrcode and not qrcode.startswith('cmd:'):
-        print(_('IGNORING REDUNDANT QRCODE: ') + qrcode)
-        return
-
     print(_('HANDLING QRCODE: ') + qrcode)
 
     if qrcode.startswith('cmd:'):
@@ -228,11 +233,9 @@ def handle_qrcode(qrcode):
     # Blink the onboard LED to give some visual indication that a code was handled
     # (especially useful for cases where there's no other auditory feedback, like
     # when adding songs to the queue)
-    if not args.debug_file:
+    if not args.debug_file and not args.replay_file:
         blink_led()
 
-    last_qrcode = qrcode
-
 
 # Read from the `debug.txt` file and handle one code at a time.
 def read_debug_script():
@@ -250,6 +253,13 @@ def read_debug_script():
             sleep(4)
 
 
+# Per stage timings, served in the Prometheus format and logged as JSON on SIGUSR1
+dump_on_signal()
+# a replay runs next to the qrplay serving the port
+if not args.replay_file and parser.getint('metrics', 'port', fallback=9101):
+    serve(parser.getint('metrics', 'port', fallback=9101),
+          parser.get('metrics', 'host', fallback='127.0.0.1'))
+
 controller.perform_global_request('pauseall')
 speak(_('Hello, I\'m qrocodile.'))
 
@@ -263,61 +273,102 @@ if not args.skip_load:
 
 speak(_('Show me a card!'))
 
+# controller calls run off the scan threads, a card that is still waiting
+# is replaced by the next card shown
+executor = DispatchExecutor().start()
+
+
+def handle_card(qrcode, captured):
+    with controller.transport.trace('card ' + qrcode):
+        handle_qrcode(qrcode)
+    if not args.replay_file:
+        # recorded frames carry the time they were captured at
+        metrics.observe('qrocodile_action_seconds', monotonic() - captured,
+                        kind='command' if qrcode.startswith('cmd:') else 'media')
+
+
+def handle_scan(scan):
+    for qrcode in scan.codes:
+        # a newer card replaces a waiting one, except while building a queue
+        # where every song shown is added
+        replaceable = not qrcode.startswith('cmd:') and current_mode != Mode.BUILD_QUEUE
+        executor.submit(handle_card, qrcode, scan.timestamp, key='play' if replaceable else None)
+
+
+tracker = None
+if parser.getboolean('scanner', 'tracking', fallback=True):
+    # only decode around the last seen card, with a full scan every few frames
+    tracker = RegionTracker(parser.getfloat('scanner', 'tracking_padding', fallback=0.5),
+                            parser.getint('scanner', 'full_scan_every', fallback=10))
+
+gate = None
+if parser.getfloat('scanner', 'motion_threshold', fallback=4.0) > 0:
+    # only run the decoder while (or shortly after) something moves
+    gate = MotionGate(parser.getfloat('scanner', 'motion_threshold', fallback=4.0),
+                      parser.getint('scanner', 'motion_hold', fallback=10))
+
+# ignore cards that stay in view, but allow commands to be repeated after a while
+debouncer = Debouncer(parser.getfloat('scanner', 'command_cooldown', fallback=2.0),
+                      parser.getfloat('scanner', 'absent_after', fallback=1.0),
+                      {'cmd:pause': parser.getfloat('scanner', 'pause_cooldown', fallback=5.0)})
+
+width = parser.getint('scanner', 'width', fallback=400)
+
+
 if args.debug_file:
     # Run through a list of codes from a local file
     read_debug_script()
+elif args.replay_file:
+    # Run recorded frames through the decoder as fast as possible
+    replay(args.replay_file, decoder, handle_scan, width,
+           tracker=tracker, gate=gate, debouncer=debouncer)
+    executor.wait()
+    executor.stop()
 else:
     # initialize video stream and wait
     vs = VideoStream(usePiCamera=isPI).start()
     sleep(2.0)
 
-    lastCommand = ''
+    # slow down capturing after a while without motion or cards
+    scheduler = RateScheduler(parser.getfloat('scanner', 'fps', fallback=30.0),
+                              parser.getfloat('scanner', 'idle_fps', fallback=2.0),
+                              parser.getfloat('scanner', 'idle_after', fallback=30.0))
+
+    recorder = FrameRecorder(args.record_file) if args.record_file else None
+
+    preview = None
+    if args.show_frame:
+        # drawn and shown on this thread, the decoder only hands over a copy now and then
+        preview = Preview(fps=parser.getfloat('scanner', 'preview_fps', fallback=10.0))
+
+    # capture, decode and dispatch run in their own threads, so a slow controller
+    # call does not keep the camera from being read
+    pipeline = ScanPipeline(vs, decoder, handle_scan, width,
+                            on_frame=preview.offer if preview else None,
+                            tracker=tracker, gate=gate, scheduler=scheduler, debouncer=debouncer,
+                            pool=decode_pool,
+                            recorder=recorder).start()
     try:
-        while True:
-            frame = vs.read()
-            # for better performance, resize the image
-            frame = imutils.resize(frame, width=400)
-            # find and decode all barcodes in this frame
-            barcodes = pyzbar.decode(frame)
-            for barcode in barcodes:
-                # the barcode data is a bytes object so if we want to draw it
-                # on our output image we need to convert it to a string first
-                barcodeData = barcode.data.decode("utf-8")
-                barcodeType = barcode.type
-
-                # display enabled
-                if args.show_frame:
-                    # extract the bounding box location of the barcode and draw
-                    # the bounding box surrounding the barcode on the image
-                    (x, y, w, h) = barcode.rect
-                    cv2.rectangle(frame, (x, y), (x + w, y + h),
-                                  (0, 0, 255), 2)
-
-                    # draw the barcode data and barcode type on the image
-                    text = "{} ({})".format(barcodeData, barcodeType)
-                    cv2.putText(frame, text, (x, y - 10),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
-
-                if barcodeData == "cmd:pause":
-                    handle_qrcode(barcodeData)
-                    lastCommand = barcodeData
-                    print(_('special handling pause, wait 5s'))
-                    sleep(5)
-                    print(_('... now checking again'))
-
-                elif barcodeData != lastCommand:
-                    handle_qrcode(barcodeData)
-                    lastCommand = barcodeData
-
-            if args.show_frame:
-                # show the output frame
-                cv2.imshow("Barcode Scanner", frame)
-                key = cv2.waitKey(1) & 0xFF
+        while pipeline.is_alive():
+            if preview:
+                preview.show()
+            else:
+                sleep(0.5)
 
     except KeyboardInterrupt:
         print(_('Stopping scanner ...'))
     finally:
-         # close the output CSV file do a bit of cleanup
+        if gate:
+            print(_('Frames skipped without motion: ') + str(gate.skipped))
+        # stop the pipeline and do a bit of cleanup
         print(_("[INFO] cleaning up..."))
-        cv2.destroyAllWindows()
+        pipeline.stop()
+        if decode_pool:
+            decode_pool.stop()
+        executor.stop()
+        if recorder:
+            recorder.close()
+        led.close()
+        if preview:
+            preview.close()
         vs.stop()
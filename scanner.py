@@ -0,0 +1,631 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+
+# create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to info
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(lineno)s:%(funcName)s - %(message)s'))
+logger.addHandler(ch)
+
+
+# a captured camera frame, numbered in capture order
+Frame = namedtuple('Frame', ['seq', 'timestamp', 'image'])
+
+# the codes of a decoded frame which passed the debouncer
+Scan = namedtuple('Scan', ['seq', 'timestamp', 'codes'])
+
+
+def put_latest(q, item):
+    """Put item into the bounded queue q, dropping the oldest entries when full."""
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                dropped = q.get_nowait()
+                logger.debug('dropping stale item %s', getattr(dropped, 'seq', dropped))
+            except queue.Empty:
+                pass
+
+
+class Preprocessor:
+    """
+    Turns camera frames into a downscaled 8-bit grayscale image for the decoder.
+
+    The grayscale and resized images are written into buffers that are kept
+    between frames (or into `out`), so the returned array is only valid until
+    the next call.
+    """
+
+    def __init__(self, width=400):
+        self.width = width
+        self._gray = None
+        self._small = None
+
+    def output_shape(self, image):
+        (height, width) = image.shape[:2]
+        if width <= self.width:
+            return (height, width)
+        return (int(height * self.width / width), self.width)
+
+    def __call__(self, image, out=None):
+        shape = self.output_shape(image)
+
+        if image.ndim == 3:
+            if out is not None and shape == image.shape[:2]:
+                return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=out)
+            if self._gray is None or self._gray.shape != image.shape[:2]:
+                self._gray = np.empty(image.shape[:2], np.uint8)
+            cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._gray)
+            image = self._gray
+
+        if shape == image.shape:
+            if out is not None:
+                np.copyto(out, image)
+                return out
+            return image
+
+        if out is None:
+            if self._small is None or self._small.shape != shape:
+                self._small = np.empty(shape, np.uint8)
+            out = self._small
+        cv2.resize(image, (shape[1], shape[0]), dst=out, interpolation=cv2.INTER_AREA)
+        return out
+
+
+class MotionGate:
+    """
+    Skips decoding while nothing moves in front of the camera.
+
+    Each frame is shrunk to a tiny thumbnail and compared to the thumbnail of
+    the last decoded frame.  Once the mean difference exceeds `threshold` (in
+    gray levels, lower reacts to smaller changes) the next `hold` frames are
+    decoded as well, so a card that comes to rest is still read.
+    """
+
+    def __init__(self, threshold=4.0, hold=10, size=(32, 24)):
+        self.threshold = threshold
+        self.hold = hold
+        self.size = size
+        self.skipped = 0
+        self._thumb = np.empty((size[1], size[0]), np.uint8)
+        self._reference = np.empty_like(self._thumb)
+        self._diff = np.empty_like(self._thumb)
+        self._has_reference = False
+        self._remaining = 0
+        self._idle_since = 0
+
+    def should_decode(self, image):
+        cv2.resize(image, self.size, dst=self._thumb, interpolation=cv2.INTER_AREA)
+
+        if not self._has_reference:
+            changed = True
+        else:
+            cv2.absdiff(self._thumb, self._reference, dst=self._diff)
+            changed = cv2.mean(self._diff)[0] > self.threshold
+
+        if changed:
+            if self._idle_since:
+                logger.debug('motion after %d skipped frames', self._idle_since)
+                self._idle_since = 0
+            self._remaining = self.hold
+        elif self._remaining > 0:
+            self._remaining -= 1
+        else:
+            self.skipped += 1
+            self._idle_since += 1
+            return False
+
+        # compare against the last decoded frame, so slow changes add up
+        self._thumb, self._reference = self._reference, self._thumb
+        self._has_reference = True
+        return True
+
+
+class RateScheduler:
+    """
+    Paces frame capture, dropping to `idle_fps` after `idle_after` seconds
+    without activity (motion or a decoded code) and back to `full_fps` on the
+    next activity.
+    """
+
+    def __init__(self, full_fps=30.0, idle_fps=2.0, idle_after=30.0):
+        self.full_fps = full_fps
+        self.idle_fps = idle_fps
+        self.idle_after = idle_after
+        self.fps = full_fps
+        self._last_activity = time.monotonic()
+        self._next_frame = 0
+        self._woken = threading.Event()
+
+    def activity(self):
+        self._last_activity = time.monotonic()
+        if self.fps != self.full_fps:
+            self._set_rate(self.full_fps)
+            self._woken.set()
+
+    def wait(self):
+        """Blocks until the next frame is due at the current rate."""
+        now = time.monotonic()
+        if self.fps == self.full_fps and now - self._last_activity > self.idle_after:
+            self._set_rate(self.idle_fps)
+
+        delay = self._next_frame - now
+        if delay > 0:
+            # activity cuts an idle wait short
+            self._woken.wait(delay)
+        self._woken.clear()
+        self._next_frame = max(self._next_frame, now) + 1.0 / self.fps
+
+    def _set_rate(self, fps):
+        logger.info('capture rate %.1f -> %.1f fps', self.fps, fps)
+        self.fps = fps
+        self._next_frame = time.monotonic()
+
+
+class RegionTracker:
+    """
+    Limits decoding to a padded crop around where a code was last seen.
+
+    Cards sit in a fixed slot, so once a code is found most following frames
+    can be decoded on a small part of the image.  A full frame is scanned
+    after a miss and every `full_scan_every` frames, so codes appearing
+    elsewhere are still picked up.
+    """
+
+    def __init__(self, padding=0.5, full_scan_every=10):
+        # padding is relative to the size of the last seen code(s)
+        self.padding = padding
+        self.full_scan_every = full_scan_every
+        self.region = None
+        self._tracked = 0
+
+    def decode(self, decode, image):
+        if self.region is None or self._tracked >= self.full_scan_every:
+            return self._full_scan(decode, image)
+
+        self._tracked += 1
+        (x0, y0, x1, y1) = self.region
+        barcodes = decode(image[y0:y1, x0:x1])
+        if not barcodes:
+            # the card moved or left, look at the whole frame again
+            return self._full_scan(decode, image)
+
+        barcodes = [_shift(b, x0, y0) for b in barcodes]
+        self._track(image, barcodes)
+        return barcodes
+
+    def _full_scan(self, decode, image):
+        self._tracked = 0
+        barcodes = decode(image)
+        self._track(image, barcodes)
+        return barcodes
+
+    def _track(self, image, barcodes):
+        if not barcodes:
+            self.region = None
+            return
+
+        x0 = min(b.rect[0] for b in barcodes)
+        y0 = min(b.rect[1] for b in barcodes)
+        x1 = max(b.rect[0] + b.rect[2] for b in barcodes)
+        y1 = max(b.rect[1] + b.rect[3] for b in barcodes)
+        pad_x = int((x1 - x0) * self.padding)
+        pad_y = int((y1 - y0) * self.padding)
+        (height, width) = image.shape[:2]
+        self.region = (max(0, x0 - pad_x), max(0, y0 - pad_y),
+                       min(width, x1 + pad_x), min(height, y1 + pad_y))
+
+
+def _shift(barcode, dx, dy):
+    (x, y, w, h) = barcode.rect
+    return barcode._replace(rect=(x + dx, y + dy, w, h))
+
+
+class Debouncer:
+    """
+    Decides which decoded codes are handled, based on capture timestamps.
+
+    A command card (`cmd:...`) is handled again after `command_cooldown`
+    seconds, or the cooldown given for it in `cooldowns`, even while it stays
+    in view.  Any other card is only handled again after it was out of view
+    for `absent_after` seconds.
+    """
+
+    def __init__(self, command_cooldown=2.0, absent_after=1.0, cooldowns=None):
+        self.command_cooldown = command_cooldown
+        self.absent_after = absent_after
+        self.cooldowns = cooldowns or {}
+        # code -> time it was last handled
+        self._handled = {}
+        # code -> time it was last seen, for codes currently in view
+        self._seen = {}
+        self._visible = []
+
+    def accept(self, codes, now):
+        accepted = []
+        for code in codes:
+            in_view = code in self._seen
+            self._seen[code] = now
+            if code.startswith('cmd:'):
+                cooldown = self.cooldowns.get(code, self.command_cooldown)
+                if code in self._handled and now - self._handled[code] < cooldown:
+                    continue
+            elif in_view:
+                continue
+            self._handled[code] = now
+            accepted.append(code)
+
+        self._visible = codes
+        self._forget(now)
+        return accepted
+
+    def unchanged(self, now):
+        """The scene did not change, so the codes seen last are still in view."""
+        for code in self._visible:
+            self._seen[code] = now
+
+    def _forget(self, now):
+        for code, seen in list(self._seen.items()):
+            if now - seen >= self.absent_after:
+                del self._seen[code]
+
+
+class StageThread(threading.Thread):
+    """A daemon thread repeating step() until stop() is called."""
+
+    def __init__(self, name):
+        super().__init__(name=name, daemon=True)
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def run(self):
+        while not self.stopped():
+            try:
+                self.step()
+            except Exception:
+                logger.exception('%s failed, continuing ...', self.name)
+
+    def step(self):
+        raise NotImplementedError
+
+
+class CaptureThread(StageThread):
+    """Reads the video stream and only keeps the newest frame(s) in frames."""
+
+    def __init__(self, stream, frames, poll_interval=0.005, scheduler=None, recorder=None):
+        super().__init__('capture')
+        self.stream = stream
+        self.frames = frames
+        self.poll_interval = poll_interval
+        self.scheduler = scheduler
+        self.recorder = recorder
+        self.seq = 0
+        self._last = None
+
+    def step(self):
+        if self.scheduler:
+            self.scheduler.wait()
+
+        with metrics.timer('qrocodile_stage_seconds', stage='capture'):
+            image = self.stream.read()
+        # imutils streams hand out the same array until the camera delivered a new one
+        if image is None or image is self._last:
+            time.sleep(self.poll_interval)
+            return
+        self._last = image
+        self.seq += 1
+        frame = Frame(self.seq, time.monotonic(), image)
+        if self.recorder:
+            self.recorder.write(frame.image, frame.timestamp)
+        put_latest(self.frames, frame)
+
+
+class DecodeStage(StageThread):
+    """Common handling of decoded frames."""
+
+    def _skip(self, frame):
+        metrics.inc('qrocodile_frames_total', result='skipped')
+        if self.debouncer:
+            self.debouncer.unchanged(frame.timestamp)
+
+    def _forward(self, seq, timestamp, barcodes):
+        metrics.inc('qrocodile_frames_total', result='hit' if barcodes else 'miss')
+        if barcodes and self.scheduler:
+            self.scheduler.activity()
+
+        codes = [barcode.data.decode('utf-8') for barcode in barcodes]
+        if self.debouncer:
+            with metrics.timer('qrocodile_stage_seconds', stage='debounce'):
+                codes = self.debouncer.accept(codes, timestamp)
+
+        if codes:
+            put_latest(self.scans, Scan(seq, timestamp, codes))
+
+
+class DecodeWorker(DecodeStage):
+    """Preprocesses and decodes captured frames, forwarding new codes to scans."""
+
+    def __init__(self, frames, scans, decode, width=400, on_frame=None, tracker=None, gate=None,
+                 scheduler=None, debouncer=None):
+        super().__init__('decode')
+        self.frames = frames
+        self.scans = scans
+        self.decode = decode
+        self.preprocess = Preprocessor(width)
+        self.on_frame = on_frame
+        self.tracker = tracker
+        self.gate = gate
+        self.scheduler = scheduler
+        self.debouncer = debouncer
+
+    def step(self):
+        try:
+            frame = self.frames.get(timeout=0.1)
+        except queue.Empty:
+            return
+        self.process(frame)
+
+    def process(self, frame):
+        """Decodes frame, returns its barcodes or None if the motion gate skipped it."""
+        # for better performance, decode a small grayscale image
+        with metrics.timer('qrocodile_stage_seconds', stage='resize'):
+            image = self.preprocess(frame.image)
+        if self.gate and not self.gate.should_decode(image):
+            self._skip(frame)
+            return None
+
+        if self.scheduler and self.gate:
+            # the gate only lets frames with (recent) motion through
+            self.scheduler.activity()
+
+        with metrics.timer('qrocodile_stage_seconds', stage='decode'):
+            if self.tracker:
+                barcodes = self.tracker.decode(self.decode, image)
+            else:
+                barcodes = self.decode(image)
+
+        if self.on_frame:
+            self.on_frame(image, barcodes)
+
+        self._forward(frame.seq, frame.timestamp, barcodes)
+        return barcodes
+
+
+def _decode_shared_frames(decode, tasks, results):
+    # runs in a forked worker process, the frames are in shared memory attached by name
+    (name, shm, ring) = (None, None, None)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        (seq, ring_name, shape, slot) = task
+        if ring_name != name:
+            if shm:
+                del ring
+                shm.close()
+            shm = shared_memory.SharedMemory(name=ring_name)
+            ring = np.ndarray(shape, np.uint8, buffer=shm.buf)
+            name = ring_name
+        try:
+            barcodes = decode(ring[slot])
+        except Exception:
+            logger.exception('decoding frame %d failed', seq)
+            barcodes = []
+        results.put((seq, slot, barcodes))
+
+
+class DecodeProcesses:
+    """
+    Worker processes decoding the frames of a PooledDecodeWorker.
+
+    The workers are forked, so start() has to be called before any thread
+    exists: a forked process only gets the calling thread, and a lock held by
+    another thread at that moment (e.g. of a logging handler) stays locked.
+    """
+
+    def __init__(self, decode, processes=2):
+        self.processes = processes
+        context = multiprocessing.get_context('fork')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self._workers = [context.Process(target=_decode_shared_frames, name='decode-%d' % i,
+                                         args=(decode, self.tasks, self.results), daemon=True)
+                         for i in range(processes)]
+
+    def start(self):
+        # shared by the workers, otherwise each would start its own and unlink the frames on exit
+        resource_tracker.ensure_running()
+        for worker in self._workers:
+            worker.start()
+        return self
+
+    def stop(self, timeout=1.0):
+        for worker in self._workers:
+            self.tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+
+
+class PooledDecodeWorker(DecodeStage):
+    """
+    Decodes frames in DecodeProcesses.
+
+    Frames are preprocessed straight into a ring of slots in shared memory, so
+    the workers only get a slot number per frame.  Their results are put back
+    into capture order before being forwarded to scans.  Frames are dropped
+    while all slots are being decoded.
+    """
+
+    def __init__(self, frames, scans, pool, frame_shape, width=400,
+                 on_frame=None, gate=None, scheduler=None, debouncer=None, slots=None):
+        super().__init__('decode')
+        self.frames = frames
+        self.scans = scans
+        self.processes = pool.processes
+        self.preprocess = Preprocessor(width)
+        self.on_frame = on_frame
+        self.gate = gate
+        self.scheduler = scheduler
+        self.debouncer = debouncer
+
+        shape = self.preprocess.output_shape(np.empty(frame_shape, np.uint8))
+        slots = slots or pool.processes * 2
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * shape[0] * shape[1])
+        self._ring = np.ndarray((slots,) + shape, np.uint8, buffer=self._shm.buf)
+        self._free = deque(range(slots))
+        # (seq, timestamp, submitted) of frames being decoded, in capture order
+        self._pending = deque()
+        self._done = {}
+
+        self._tasks = pool.tasks
+        self._results = pool.results
+
+    def start(self):
+        logger.info('decoding with %d processes in %d shared slots of %s',
+                    self.processes, len(self._ring), self._ring.shape[1:])
+        super().start()
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self._close()
+
+    def step(self):
+        self._collect()
+
+        try:
+            frame = self.frames.get(timeout=0.01)
+        except queue.Empty:
+            return
+
+        if not self._free:
+            logger.debug('all slots busy, dropping frame %d', frame.seq)
+            return
+
+        slot = self._free.popleft()
+        with metrics.timer('qrocodile_stage_seconds', stage='resize'):
+            image = self.preprocess(frame.image, out=self._ring[slot])
+        if self.gate and not self.gate.should_decode(image):
+            self._free.append(slot)
+            self._skip(frame)
+            return
+
+        if self.scheduler and self.gate:
+            self.scheduler.activity()
+
+        self._pending.append((frame.seq, frame.timestamp, time.perf_counter()))
+        self._tasks.put((frame.seq, self._shm.name, self._ring.shape, slot))
+
+    def _collect(self):
+        while True:
+            try:
+                (seq, slot, barcodes) = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._done[seq] = (slot, barcodes, time.perf_counter())
+
+        # only forward in capture order
+        while self._pending and self._pending[0][0] in self._done:
+            (seq, timestamp, submitted) = self._pending.popleft()
+            (slot, barcodes, decoded) = self._done.pop(seq)
+            # includes waiting for a free worker process
+            metrics.observe('qrocodile_stage_seconds', decoded - submitted, stage='decode')
+
+            if self.on_frame:
+                self.on_frame(self._ring[slot], barcodes)
+            self._free.append(slot)
+
+            self._forward(seq, timestamp, barcodes)
+
+    def _close(self):
+        # the workers keep running, they are stopped with their DecodeProcesses
+        del self._ring
+        self._shm.close()
+        self._shm.unlink()
+
+
+class DispatchWorker(StageThread):
+    """Hands decoded scans to the (possibly slow) handler."""
+
+    def __init__(self, scans, handle):
+        super().__init__('dispatch')
+        self.scans = scans
+        self.handle = handle
+
+    def step(self):
+        try:
+            scan = self.scans.get(timeout=0.1)
+        except queue.Empty:
+            return
+
+        logger.debug('dispatching frame %d, %.0fms after capture',
+                     scan.seq, (time.monotonic() - scan.timestamp) * 1000)
+        self.handle(scan)
+
+
+class ScanPipeline:
+    """
+    Capture, decode and dispatch stages connected by bounded queues.
+
+    A slow handler (e.g. a pending NAS request) never stalls the camera: the
+    capture and decode stages keep running and stale frames/scans are dropped,
+    so the newest card is handled as soon as the dispatcher is free again.
+    """
+
+    def __init__(self, stream, decode, handle, width=400, on_frame=None, tracker=None, gate=None,
+                 scheduler=None, debouncer=None, pool=None, recorder=None, queue_size=2):
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.scans = queue.Queue(maxsize=queue_size)
+
+        if pool:
+            # region tracking depends on the previous result, so it is not used with a pool
+            decoder = PooledDecodeWorker(self.frames, self.scans, pool, stream.read().shape,
+                                         width, on_frame, gate, scheduler, debouncer)
+        else:
+            decoder = DecodeWorker(self.frames, self.scans, decode, width, on_frame, tracker, gate,
+                                   scheduler, debouncer)
+
+        self.stages = [
+            CaptureThread(stream, self.frames, scheduler=scheduler, recorder=recorder),
+            decoder,
+            DispatchWorker(self.scans, handle)
+        ]
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def stop(self, timeout=2.0):
+        for stage in self.stages:
+            stage.stop()
+        for stage in self.stages:
+            stage.join(timeout)
+
+    def is_alive(self):
+        return all(stage.is_alive() for stage in self.stages)
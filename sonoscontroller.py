@@ -1,6 +1,6 @@
-from controller import PlayController, GenerateController, strip_title_junk
-import json
-import subprocess
+from controller import PlayController, GenerateController, strip_title_junk, traced
+import os
+from urllib.parse import urlparse
 
 # Removes extra junk from titles, e.g:
 #   (Original Motion Picture Soundtrack)
@@ -28,6 +28,7 @@ class SonosController(PlayController, GenerateController):
     def playpause(self):
         self.perform_room_request('playpause')
 
+    @traced
     def handle_command(self, qrcode):
         if qrcode == 'cmd:playpause':
             self.perform_room_request('playpause')
@@ -59,10 +60,9 @@ class SonosController(PlayController, GenerateController):
         else:
             return 'Hmm, I don\'t recognize that command : {}'.format(qrcode)
 
+    @traced
     def get_library_track(self, uri):
-        track_json = self.perform_request(
-            self.base_url + '/musicsearch/library/metadata/' + uri)
-        track = json.loads(track_json)
+        track = self.perform_request('musicsearch/library/metadata/' + uri)
         print(track)
 
         song, artist, album, arturl = [strip_title_junk(track[k]) for k in (
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+# create logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# create console handler and set level to info
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+ch.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(lineno)s:%(funcName)s - %(message)s'))
+logger.addHandler(ch)
+
+
+ApiInfo = namedtuple('ApiInfo', ['path', 'min_version', 'max_version', 'request_format'])
+
+
+def _compact(apis):
+    """Turns SYNO.API.Info entries into {api: [path, minVersion, maxVersion, requestFormat]}."""
+    return {name: [info['path'], info['minVersion'], info['maxVersion'], info.get('requestFormat')]
+            for (name, info) in apis.items()}
+
+
+def build_index(source='synology-api.json', target='synology-api-index.json'):
+    """Generates the compact index shipped with qrocodile from a full SYNO.API.Info dump."""
+    with open(source) as source_file:
+        apis = json.load(source_file)['data']
+    with open(target, 'w') as target_file:
+        json.dump(_compact(apis), target_file, separators=(',', ':'), sort_keys=True)
+    logger.info('wrote %d APIs to %s', len(apis), target)
+
+
+class ApiIndex:
+    """
+    Where to find each Synology API, loaded on first use.
+
+    Entries come from the answer of the NAS itself (`cache_file`, see
+    refresh()) when available, otherwise from the index generated from
+    synology-api.json.
+    """
+
+    def __init__(self, index_file='synology-api-index.json', cache_file='.synology-api-cache.json'):
+        self.index_file = index_file
+        self.cache_file = cache_file
+        self._apis = None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, api):
+        return ApiInfo(*self._entries()[api])
+
+    def __contains__(self, api):
+        return api in self._entries()
+
+    def path(self, api):
+        return self._entries()[api][0]
+
+    def cache_age(self):
+        try:
+            return time.time() - os.path.getmtime(self.cache_file)
+        except OSError:
+            return None
+
+    def refresh(self, transport, base_url, backend='diskstation'):
+        """Asks the NAS for its APIs (no login needed) and caches the answer on disk."""
+        payload = {'api': 'SYNO.API.Info', 'version': 1, 'method': 'query', 'query': 'all'}
+        rsp = transport.get_json(base_url + '/query.cgi', payload, backend, 'SYNO.API.Info')
+        if not rsp.get('success'):
+            raise ValueError('API query failed: %s' % rsp.get('error'))
+
+        apis = _compact(rsp['data'])
+        with open(self.cache_file + '.tmp', 'w') as cache_file:
+            json.dump(apis, cache_file, separators=(',', ':'))
+        os.replace(self.cache_file + '.tmp', self.cache_file)
+        with self._lock:
+            self._apis = apis
+        logger.info('refreshed %d APIs from %s', len(apis), base_url)
+
+    def _entries(self):
+        if self._apis is None:
+            with self._lock:
+                if self._apis is None:
+                    self._apis = self._load()
+        return self._apis
+
+    def _load(self):
+        for filename in (self.cache_file, self.index_file):
+            try:
+                with open(filename) as index_file:
+                    return json.load(index_file)
+            except (OSError, ValueError):
+                continue
+        raise FileNotFoundError('no API index, run `python synologyapi.py --build`')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Generates the compact Synology API index from synology-api.json.')
+    arg_parser.add_argument('--build', action='store_true', required=True,
+                            help='(re)generate the index')
+    arg_parser.add_argument('--source', default='synology-api.json',
+                            help='SYNO.API.Info query result to generate the index from')
+    arg_parser.add_argument('--target', default='synology-api-index.json',
+                            help='the index file to write')
+    args = arg_parser.parse_args()
+
+    build_index(args.source, args.target)
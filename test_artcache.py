@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from artcache import ArtworkCache
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise OSError('HTTP %d' % self.status_code)
+
+
+class FakeTransport:
+    """Serves one image per URL with an ETag, honouring If-None-Match."""
+
+    def __init__(self):
+        self.images = {}
+        # request headers of every request
+        self.requests = []
+        self.down = False
+
+    def get(self, url, backend=None, api=None, headers=None):
+        self.requests.append(dict(headers or {}))
+        if self.down:
+            raise OSError('connection refused')
+        if url not in self.images:
+            return FakeResponse(404)
+        (content, etag) = self.images[url]
+        if (headers or {}).get('If-None-Match') == etag:
+            return FakeResponse(304, headers={'ETag': etag})
+        return FakeResponse(200, content, {'ETag': etag, 'Last-Modified': 'Sat, 17 Oct 2026 04:00:00 GMT'})
+
+
+class ArtworkCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='qrocodile-test-')
+        self.transport = FakeTransport()
+        self.transport.images['http://nas/cover?sid=1'] = (b'cover 1', '"v1"')
+        self.target = os.path.join(self.workdir, 'card.jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def cache(self, max_age=86400):
+        return ArtworkCache(os.path.join(self.workdir, 'cache'), max_age, self.transport)
+
+    def fetched(self):
+        with open(self.target, 'rb') as target:
+            return target.read()
+
+    def test_cached_image_is_not_asked_for_again(self):
+        self.assertTrue(self.cache().fetch('http://nas/cover?sid=1', self.target, 'album'))
+        self.assertEqual(self.fetched(), b'cover 1')
+        # a new session id, but the same key, also after a restart
+        self.assertTrue(self.cache().fetch('http://nas/cover?sid=2', self.target, 'album'))
+        self.assertEqual(len(self.transport.requests), 1)
+
+    def test_unchanged_image_is_revalidated(self):
+        cache = self.cache(max_age=0)
+        cache.fetch('http://nas/cover?sid=1', self.target, 'album')
+        os.remove(self.target)
+        self.assertTrue(cache.fetch('http://nas/cover?sid=1', self.target, 'album'))
+        self.assertEqual(self.transport.requests[1],
+                         {'If-None-Match': '"v1"', 'If-Modified-Since': 'Sat, 17 Oct 2026 04:00:00 GMT'})
+        self.assertEqual(self.fetched(), b'cover 1')
+
+    def test_changed_image_is_downloaded(self):
+        cache = self.cache(max_age=0)
+        cache.fetch('http://nas/cover?sid=1', self.target, 'album')
+        self.transport.images['http://nas/cover?sid=1'] = (b'cover 2', '"v2"')
+        self.assertTrue(cache.fetch('http://nas/cover?sid=1', self.target, 'album'))
+        self.assertEqual(self.fetched(), b'cover 2')
+
+    def test_cached_image_is_used_when_the_nas_is_down(self):
+        cache = self.cache(max_age=0)
+        cache.fetch('http://nas/cover?sid=1', self.target, 'album')
+        self.transport.down = True
+        self.assertTrue(cache.fetch('http://nas/cover?sid=1', self.target, 'album'))
+        self.assertEqual(self.fetched(), b'cover 1')
+        self.assertFalse(cache.fetch('http://nas/cover?sid=1', self.target, 'other album'))
+
+    def test_missing_image(self):
+        self.assertFalse(self.cache().fetch('http://nas/none', self.target, 'album'))
+        self.assertFalse(os.path.exists(self.target))
+
+    def test_same_image_is_stored_once(self):
+        self.transport.images['http://nas/other'] = (b'cover 1', '"v1"')
+        cache = self.cache()
+        cache.fetch('http://nas/cover?sid=1', self.target, 'album')
+        cache.fetch('http://nas/other', self.target, 'same album, other artist')
+        blobs = [name for name in os.listdir(cache.directory) if name != 'index.json']
+        self.assertEqual(len(blobs), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from controller import request_budget
+from diskstationcontroller import DiskstationController
+from fakesynology import FakeSynology, _actions
+from libraryindex import LibraryIndex
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# requests allowed per action, in the order fakesynology._actions() runs them
+BUDGETS = {
+    'play album': 2,        # count the queue, replace it
+    'play song': 2,         # the album left the queue size unknown
+    'cmd:pause': 1,
+    'cmd:play': 1,
+    'cmd:next': 1,
+    'cmd:clear': 1,         # the queue size is tracked
+    'play video': 1,
+    'cmd:stop': 2,          # audio and video play, stopped at the same time
+    'get_song': 1,
+    'get_album': 1,
+    'get_artist': 1,
+    'get_movie': 1,
+    'get_episode': 1,
+    '20 lookups': 20,
+    'library sync': 15,     # one page per kind, the episodes per show
+    '20 lookups (index)': 0,
+}
+
+
+class RequestBudgetTest(unittest.TestCase):
+    """Runs the qrplay actions against a FakeSynology, each within its request budget."""
+
+    def setUp(self):
+        self.fake = FakeSynology(api_index=os.path.join(HERE, 'synology-api-index.json')).start()
+        self.workdir = tempfile.mkdtemp(prefix='qrocodile-test-')
+        # the controller reads the API index from the working directory
+        shutil.copy(os.path.join(HERE, 'synology-api-index.json'), self.workdir)
+        self.cwd = os.getcwd()
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.fake.stop()
+        shutil.rmtree(self.workdir)
+
+    def create(self):
+        controller = DiskstationController(
+            self.fake.url, 'user', 'secret', 'TV', 'QRocodile',
+            library=LibraryIndex(os.path.join(self.workdir, 'library.db')),
+            # polling the players would add requests to every action
+            status_interval=0)
+        self.assertTrue(controller.wait_players(10))
+        return controller
+
+    def test_actions(self):
+        controller = self.create()
+        for (name, action) in _actions(controller, self.fake):
+            with self.subTest(name):
+                before = self.fake.stats()['requests']
+                with request_budget(BUDGETS[name], transport=controller.transport) as trace:
+                    action()
+                # requests made by threads the trace does not follow count as well
+                self.assertEqual(self.fake.stats()['requests'] - before, trace.count)
+
+    def test_tracked_queue(self):
+        controller = self.create()
+        controller.switch_mode('audio')
+        with request_budget(2, transport=controller.transport):
+            controller.play_audio(self.fake.library.songs[0]['id'])
+        # the queue holds the song just played, no need to count it again
+        with request_budget(1, transport=controller.transport):
+            controller.play_audio(self.fake.library.songs[1]['id'])
+        with request_budget(1, transport=controller.transport):
+            controller.load_audio(self.fake.library.songs[2]['id'])
+        self.assertEqual(len(self.fake.playlist), 2)
+
+    def test_queue_building(self):
+        controller = self.create()
+        controller.switch_mode('audio')
+        album = self.fake.library.albums[0]
+        controller.play_audio('[{"type":"album","album":"%s","album_artist":"%s"}]'
+                              % (album['name'], album['album_artist']))
+        queued = len(self.fake.playlist)
+        # appending a card needs neither the queue size nor a play command
+        for song in self.fake.library.songs[-3:]:
+            with request_budget(1, transport=controller.transport):
+                controller.load_audio(song['id'])
+        self.assertEqual(self.fake.playlist[:queued], self.fake.library.album_songs(album['name']))
+        self.assertEqual(self.fake.playlist[queued:], [s['id'] for s in self.fake.library.songs[-3:]])
+
+
+if __name__ == '__main__':
+    unittest.main()
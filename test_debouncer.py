@@ -0,0 +1,52 @@
+import unittest
+
+from scanner import Debouncer
+
+
+class DebouncerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.debouncer = Debouncer(command_cooldown=2.0, absent_after=1.0,
+                                   cooldowns={'cmd:pause': 5.0})
+
+    def test_card_in_view_is_handled_once(self):
+        self.assertEqual(self.debouncer.accept(['dsaudio:music_1'], 0.0), ['dsaudio:music_1'])
+        for now in (0.5, 1.0, 10.0):
+            self.assertEqual(self.debouncer.accept(['dsaudio:music_1'], now), [])
+
+    def test_card_shown_again_after_leaving_the_view(self):
+        self.debouncer.accept(['dsaudio:music_1'], 0.0)
+        self.debouncer.accept([], 0.5)
+        # gone for less than absent_after, still the same showing
+        self.assertEqual(self.debouncer.accept(['dsaudio:music_1'], 0.9), [])
+        self.debouncer.accept([], 1.5)
+        self.debouncer.accept([], 2.0)
+        self.assertEqual(self.debouncer.accept(['dsaudio:music_1'], 2.1), ['dsaudio:music_1'])
+
+    def test_unchanged_scene_keeps_the_card_in_view(self):
+        self.debouncer.accept(['dsaudio:music_1'], 0.0)
+        # the motion gate skipped these frames
+        self.debouncer.unchanged(0.8)
+        self.debouncer.unchanged(1.6)
+        self.assertEqual(self.debouncer.accept(['dsaudio:music_1'], 2.0), [])
+
+    def test_command_repeats_after_its_cooldown(self):
+        self.assertEqual(self.debouncer.accept(['cmd:next'], 0.0), ['cmd:next'])
+        self.assertEqual(self.debouncer.accept(['cmd:next'], 1.9), [])
+        # still in view, but commands only wait for the cooldown
+        self.assertEqual(self.debouncer.accept(['cmd:next'], 2.0), ['cmd:next'])
+
+    def test_command_with_its_own_cooldown(self):
+        self.assertEqual(self.debouncer.accept(['cmd:pause'], 0.0), ['cmd:pause'])
+        self.assertEqual(self.debouncer.accept(['cmd:pause'], 4.9), [])
+        self.assertEqual(self.debouncer.accept(['cmd:pause'], 5.0), ['cmd:pause'])
+
+    def test_cards_are_debounced_independently(self):
+        self.assertEqual(self.debouncer.accept(['dsaudio:music_1', 'cmd:next'], 0.0),
+                         ['dsaudio:music_1', 'cmd:next'])
+        self.assertEqual(self.debouncer.accept(['dsaudio:music_1', 'dsaudio:music_2'], 0.5),
+                         ['dsaudio:music_2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
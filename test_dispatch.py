@@ -0,0 +1,69 @@
+import threading
+import unittest
+
+from dispatch import DispatchExecutor
+
+
+class DispatchExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = DispatchExecutor('test')
+        self.ran = []
+
+    def tearDown(self):
+        self.executor.stop()
+
+    def record(self, name):
+        self.ran.append(name)
+
+    def run_pending(self):
+        self.executor.start()
+        self.assertTrue(self.executor.wait(5))
+
+    def test_keyed_action_replaces_a_pending_one(self):
+        self.executor.submit(self.record, 'album 1', key='play')
+        self.executor.submit(self.record, 'album 2', key='play')
+        self.run_pending()
+        self.assertEqual(self.ran, ['album 2'])
+        self.assertEqual(self.executor.coalesced, 1)
+
+    def test_unkeyed_actions_are_kept_in_order(self):
+        self.executor.submit(self.record, 'cmd:pause')
+        self.executor.submit(self.record, 'album 1', key='play')
+        self.executor.submit(self.record, 'cmd:next')
+        self.executor.submit(self.record, 'cmd:next')
+        self.executor.submit(self.record, 'album 2', key='play')
+        self.run_pending()
+        # the replacing action is queued behind the ones submitted before it
+        self.assertEqual(self.ran, ['cmd:pause', 'cmd:next', 'cmd:next', 'album 2'])
+
+    def test_running_action_is_not_replaced(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def play(name):
+            started.set()
+            release.wait(5)
+            self.record(name)
+
+        self.executor.start()
+        self.executor.submit(play, 'album 1', key='play')
+        self.assertTrue(started.wait(5))
+        self.executor.submit(self.record, 'album 2', key='play')
+        release.set()
+        self.assertTrue(self.executor.wait(5))
+        self.assertEqual(self.ran, ['album 1', 'album 2'])
+        self.assertEqual(self.executor.coalesced, 0)
+
+    def test_failing_action_does_not_stop_the_executor(self):
+        def fail(name):
+            raise RuntimeError(name)
+
+        self.executor.submit(fail, 'album 1')
+        self.executor.submit(self.record, 'album 2')
+        self.run_pending()
+        self.assertEqual(self.ran, ['album 2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+
+import libraryindex
+from libraryindex import LibraryIndex
+
+
+def _song(id, album='Greatest Hits', artist='ABBA'):
+    return {'id': id, 'title': 'Song %s' % id,
+            'additional': {'song_tag': {'album': album, 'artist': artist, 'album_artist': artist}}}
+
+
+class FakeLibrary:
+    """Answers the list requests of LibraryIndex.sync() page by page."""
+
+    KEYS = {'SYNO.AudioStation.Song': 'songs', 'SYNO.AudioStation.Album': 'albums',
+            'SYNO.AudioStation.Artist': 'artists', 'SYNO.VideoStation2.Movie': 'movie',
+            'SYNO.VideoStation2.TVShow': 'tvshow', 'SYNO.VideoStation2.TVShowEpisode': 'episode'}
+
+    def __init__(self):
+        self.entries = {
+            'songs': [_song('music_%d' % i) for i in range(5)],
+            'albums': [{'name': 'Greatest Hits', 'album_artist': 'ABBA'},
+                       {'name': 'Greatest Hits', 'album_artist': 'Queen'},
+                       {'name': 'Arrival', 'album_artist': 'ABBA'}],
+            'artists': [{'name': 'ABBA'}, {'name': 'Queen'}],
+            'movie': [{'id': 1, 'title': 'Movie', 'additional': {'file': [{'id': 10}]}}],
+            'tvshow': [{'id': 7, 'title': 'Show'}],
+            'episode': [{'id': 70, 'title': 'Show', 'tagline': 'Pilot',
+                         'additional': {'file': [{'id': 700}]}}]}
+        # (api, offset) of every request
+        self.requests = []
+        self.fail_at = None
+
+    def request(self, path, payload, mode):
+        key = self.KEYS[payload['api']]
+        self.requests.append((payload['api'], payload['offset']))
+        if (payload['api'], payload['offset']) == self.fail_at:
+            raise OSError('connection lost')
+        entries = self.entries[key]
+        page = entries[payload['offset']:payload['offset'] + payload['limit']]
+        return {key: page, 'total': len(entries)}
+
+    def offsets(self, api):
+        return [offset for (a, offset) in self.requests if a == api]
+
+
+@mock.patch.object(libraryindex, 'PAGE_SIZE', 2)
+class LibraryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = FakeLibrary()
+        self.index = LibraryIndex(':memory:')
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_lookups(self):
+        self.index.sync(self.library.request)
+        self.assertEqual(self.index.song('music_3')['title'], 'Song music_3')
+        self.assertEqual(self.index.album('greatest hits', 'queen')['album_artist'], 'Queen')
+        self.assertEqual(self.index.album('ARRIVAL')['album_artist'], 'ABBA')
+        self.assertEqual(self.index.artist('abba')['name'], 'ABBA')
+        self.assertEqual(self.index.movie(1)['file_id'], 10)
+        self.assertEqual(self.index.episode(70)['tvshow_id'], '7')
+
+    def test_album_of_another_artist_is_no_match(self):
+        self.index.sync(self.library.request)
+        self.assertIsNone(self.index.album('Arrival', 'Queen'))
+
+    def test_interrupted_sync_continues(self):
+        self.library.fail_at = ('SYNO.AudioStation.Song', 4)
+        self.index.sync(self.library.request, kinds=['songs'])
+        self.assertIsNone(self.index.age('songs'))
+        self.assertIsNone(self.index.song('music_4'))
+
+        self.library.fail_at = None
+        self.index.sync(self.library.request, kinds=['songs'])
+        # the pages before the failure are not asked for again
+        self.assertEqual(self.library.offsets('SYNO.AudioStation.Song'), [0, 2, 4, 4])
+        self.assertIsNotNone(self.index.age('songs'))
+        self.assertEqual([self.index.song('music_%d' % i)['id'] for i in range(5)],
+                         ['music_%d' % i for i in range(5)])
+
+    def test_removed_entries_are_dropped(self):
+        self.index.sync(self.library.request)
+        del self.library.entries['songs'][1]
+        del self.library.entries['albums'][2]
+        self.index.sync(self.library.request)
+        self.assertIsNone(self.index.song('music_1'))
+        self.assertIsNone(self.index.album('Arrival'))
+        self.assertIsNotNone(self.index.song('music_0'))
+        self.assertIsNotNone(self.index.album('Greatest Hits', 'ABBA'))
+
+    def test_recent_sync_is_skipped(self):
+        self.index.sync(self.library.request)
+        requests = len(self.library.requests)
+        self.index.sync(self.library.request, max_age=60)
+        self.assertEqual(len(self.library.requests), requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from diskstationcontroller import DiskstationController, SynologyException
+from fakesynology import FakeSynology
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class ReloginTest(unittest.TestCase):
+    """A lost session is logged into again and the request retried once."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='qrocodile-test-')
+        # the controller reads the API index from the working directory
+        shutil.copy(os.path.join(HERE, 'synology-api-index.json'), self.workdir)
+        self.cwd = os.getcwd()
+        os.chdir(self.workdir)
+        self.fake = None
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        if self.fake:
+            self.fake.stop()
+        shutil.rmtree(self.workdir)
+
+    def create(self, **fake_settings):
+        if not self.fake:
+            self.fake = FakeSynology(library_size=100, **fake_settings).start()
+        controller = DiskstationController(self.fake.url, 'user', 'secret', 'TV', 'QRocodile',
+                                           status_interval=0)
+        self.assertTrue(controller.wait_players(10))
+        return controller
+
+    def song(self, controller, index=0):
+        return controller.get_song(self.fake.library.songs[index]['id'])
+
+    def test_lost_session(self):
+        for code in (106, 107, 119):
+            with self.subTest(code):
+                if self.fake:
+                    self.fake.stop()
+                    self.fake = None
+                controller = self.create(error_every=3, error_code=code)
+                for index in range(6):
+                    self.assertTrue(self.song(controller, index))
+
+    def test_expired_session(self):
+        controller = self.create()
+        self.song(controller)
+        logins = self.fake.issued
+        self.fake.expire_sessions()
+        self.assertTrue(self.song(controller))
+        self.assertEqual(self.fake.issued, logins + 1)
+
+    def test_parallel_requests_login_once(self):
+        controller = self.create()
+        self.song(controller)
+        logins = self.fake.issued
+        self.fake.expire_sessions()
+        uris = ['dsaudio:song=%s' % s['id'] for s in self.fake.library.songs[:10]]
+        self.assertTrue(all(controller.get_library_tracks(uris)))
+        # the audio session only
+        self.assertEqual(self.fake.issued, logins + 1)
+
+    def test_other_errors_are_not_retried(self):
+        controller = self.create(error_every=1, error_code=105)
+        logins = self.fake.issued
+        with self.assertRaises(SynologyException) as raised:
+            controller.perform_request(None, {'api': 'SYNO.AudioStation.Song', 'method': 'getinfo',
+                                              'version': 2, 'id': 'music_1'}, 'audio')
+        self.assertEqual(raised.exception.code, 105)
+        self.assertEqual(self.fake.issued, logins)
+
+    def test_cached_session_is_reused(self):
+        controller = self.create()
+        self.song(controller)
+        logins = self.fake.issued
+        controller = self.create()
+        self.assertTrue(self.song(controller))
+        self.assertEqual(self.fake.issued, logins)
+
+
+if __name__ == '__main__':
+    unittest.main()